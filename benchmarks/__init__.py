@@ -0,0 +1,8 @@
+"""
+Benchmarks for tg-archive on synthetic archives.
+
+    python -m benchmarks.generate data.sqlite --messages 100000
+    python -m benchmarks.run --messages 100000 --output results.json
+
+The benchmarks are not part of the package and are run from the repository root.
+"""
@@ -0,0 +1,116 @@
+"""
+A fake Telegram client that serves a synthetic group's history to Sync
+from memory, to benchmark the sync without the network.
+"""
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import telethon.tl.types as types
+
+from .generate import _text
+
+
+class FakeClient:
+    """
+    Implements the subset of the Telethon client that Sync uses. Like
+    Telethon's sync wrappers, get_messages() returns a coroutine when it's
+    called from the running event loop and its result otherwise. Each
+    request takes latency seconds.
+    """
+
+    def __init__(self, messages=10000, users=100, photos=0.1, webpages=0.05, polls=0.01,
+                 replies=0.2, latency=0, seed=1):
+        self.loop = asyncio.get_event_loop()
+        self.latency = latency
+        self.requests = 0
+
+        self.photos, self.webpages, self.polls, self.replies = photos, webpages, polls, replies
+        self._r = r = random.Random(seed)
+        self.users = [types.User(id=i, username="user{}".format(i), first_name="First{}".format(i),
+                                 last_name="Last{}".format(i), bot=r.random() < 0.02)
+                      for i in range(1, users + 1)]
+
+        self._date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+        self.messages = []
+        for _ in range(messages):
+            self.add_message()
+
+    def add_message(self) -> int:
+        """Add a new message to the end of the history and return its ID."""
+        r, id = self._r, len(self.messages) + 1
+        photos, webpages, polls = self.photos, self.webpages, self.polls
+        self._date += timedelta(seconds=r.randint(1, 3600))
+
+        media, file = None, None
+        x = r.random()
+        if x < photos:
+            media = types.MessageMediaPhoto(photo=None)
+            file = SimpleNamespace(name=None, size=r.randint(10000, 2000000),
+                                   mime_type="image/jpeg", width=1280, height=960)
+        elif x < photos + webpages:
+            media = types.MessageMediaWebPage(webpage=types.WebPage(
+                id=id, url="https://example.com/{}".format(id),
+                display_url="example.com/{}".format(id), hash=0,
+                title="Page {}".format(id), description=_text(r)))
+        elif x < photos + webpages + polls:
+            media = self._make_poll(id, r)
+
+        reply_to = None
+        if id > 1 and r.random() < self.replies:
+            reply_to = r.randint(max(1, id - 200), id - 1)
+
+        self.messages.append(SimpleNamespace(
+            id=id, date=self._date, edit_date=None, raw_text=_text(r), media=media, file=file,
+            action=None, sender=r.choice(self.users), chat=None,
+            reply_to=types.MessageReplyHeader(reply_to_msg_id=reply_to) if reply_to else None,
+            reply_to_msg_id=reply_to))
+        return id
+
+    def _make_poll(self, id, r):
+        n = r.randint(2, 5)
+        text = lambda s: types.TextWithEntities(text=s, entities=[])
+        poll = types.Poll(id=id, question=text("Question {}?".format(id)), hash=0,
+                          answers=[types.PollAnswer(text=text("Option {}".format(i + 1)),
+                                                    option=bytes([i])) for i in range(n)])
+        votes = [types.PollAnswerVoters(option=bytes([i]), voters=r.randint(0, 50))
+                 for i in range(n)]
+        return types.MessageMediaPoll(poll=poll, results=types.PollResults(
+            results=votes, total_voters=sum(v.voters for v in votes)))
+
+    def get_entity(self, entity):
+        return types.Channel(id=1, title="Benchmark", photo=types.ChatPhotoEmpty(), date=None,
+                             access_hash=1)
+
+    def get_input_entity(self, entity):
+        return types.InputPeerChannel(entity.id, entity.access_hash)
+
+    def get_dialogs(self):
+        return []
+
+    def get_messages(self, group, *args, **kwargs):
+        coro = self._get_messages(group, *args, **kwargs)
+        if self.loop.is_running():
+            return coro
+        return self.loop.run_until_complete(coro)
+
+    async def _get_messages(self, group, offset_id=0, limit=100, ids=None, reverse=False,
+                            max_id=0, wait_time=None):
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if ids is not None:
+            ids = ids if isinstance(ids, list) else [ids]
+            return [self.messages[i - 1] if 0 < i <= len(self.messages) else None for i in ids]
+
+        if not reverse:
+            return self.messages[::-1][:limit]
+
+        # IDs are 1..n, so the messages after offset_id start at that index.
+        end = min(max_id - 1, len(self.messages)) if max_id else len(self.messages)
+        return self.messages[offset_id:end][:limit]
+
+    def add_event_handler(self, callback, event):
+        pass
@@ -0,0 +1,139 @@
+"""
+Generate a synthetic tg-archive DB of a given scale for benchmarking.
+
+    python -m benchmarks.generate data.sqlite --messages 100000 --users 500 --months 24
+"""
+import argparse
+import json
+import logging
+import os
+import random
+from datetime import datetime, timedelta, timezone
+
+from tgarchive.db import DB, User, Message, Media
+
+_WORDS = ("the a an is to of and in on for with this that group message archive "
+          "telegram python sqlite build page static site search reply thanks "
+          "please anyone know how why when release version bug fix issue docs").split()
+
+
+def _text(r):
+    """Random message text of a few words to a few paragraphs, some with links."""
+    paras = []
+    for _ in range(r.choice((1, 1, 1, 2, 3))):
+        paras.append(" ".join(r.choice(_WORDS) for _ in range(r.randint(3, 40))))
+
+    if r.random() < 0.1:
+        paras.append("https://example.com/{}".format(r.randint(1, 10000)))
+    return "\n\n".join(paras)
+
+
+def make_users(n, seed=1):
+    r = random.Random(seed)
+    return [User(id=i,
+                 username="user{}".format(i),
+                 first_name="First{}".format(i),
+                 last_name="Last{}".format(i) if r.random() < 0.7 else None,
+                 tags=["bot"] if r.random() < 0.02 else [],
+                 avatar="avatar_{}.jpg".format(i) if r.random() < 0.5 else None)
+            for i in range(1, n + 1)]
+
+
+def make_poll(id, r):
+    votes = [r.randint(0, 50) for _ in range(r.randint(2, 5))]
+    total = sum(votes)
+    options = [{"label": "Option {}".format(i + 1),
+                "count": v,
+                "correct": False,
+                "percent": v / total * 100 if total > 0 else 0}
+               for i, v in enumerate(votes)]
+    return Media(id=id, type="poll", url=None, title="Question {}?".format(id),
+                 description=json.dumps(options), thumb=None)
+
+
+def generate(path, messages=10000, users=100, months=12, photos=0.1, webpages=0.05,
+             polls=0.01, replies=0.2, edits=0.05, seed=1, batch_size=5000):
+    """
+    Write a synthetic archive of messages by users spread evenly over
+    months (starting Jan 2020) into a new DB at path. photos, webpages,
+    polls, replies and edits are the fractions of messages that have them.
+    Most replies are to recent messages, and some are to any earlier
+    message, across months.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+
+    r = random.Random(seed)
+    db = DB(path)
+    db.set_bulk_mode()
+
+    people = make_users(users, seed)
+    date = datetime(2020, 1, 1, tzinfo=timezone.utc)
+    step = months * 30 * 86400 / max(messages, 1)
+
+    batch = []
+    for id in range(1, messages + 1):
+        date += timedelta(seconds=r.uniform(0, 2 * step))
+
+        media = None
+        x = r.random()
+        if x < photos:
+            media = Media(id=id, type="photo", url="{}.jpg".format(id),
+                          title="photo_{}.jpg".format(id), description=None,
+                          thumb="thumb_{}.jpg".format(id),
+                          size=r.randint(10000, 2000000), mime="image/jpeg",
+                          width=1280, height=960)
+        elif x < photos + webpages:
+            media = Media(id=id, type="webpage", url="https://example.com/{}".format(id),
+                          title="Page {}".format(id), description=_text(r), thumb=None)
+        elif x < photos + webpages + polls:
+            media = make_poll(id, r)
+
+        reply_to = None
+        if id > 1 and r.random() < replies:
+            reply_to = r.randint(max(1, id - 200), id - 1) if r.random() < 0.8 else r.randint(1, id - 1)
+
+        batch.append(Message(id=id,
+                             type="message",
+                             date=date,
+                             edit_date=date + timedelta(minutes=r.randint(1, 60))
+                             if r.random() < edits else None,
+                             content=_text(r),
+                             reply_to=reply_to,
+                             user=r.choice(people),
+                             media=media))
+
+        if len(batch) >= batch_size:
+            db.insert_messages(batch)
+            batch = []
+
+    if batch:
+        db.insert_messages(batch)
+    db.commit()
+    db.end_bulk_mode()
+    db.conn.close()
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Generate a synthetic tg-archive DB for benchmarking.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument("path", help="path of the SQLite DB to create (overwritten)")
+    p.add_argument("--messages", type=int, default=10000, help="number of messages")
+    p.add_argument("--users", type=int, default=100, help="number of users")
+    p.add_argument("--months", type=int, default=12, help="number of months to spread the messages over")
+    p.add_argument("--photos", type=float, default=0.1, help="fraction of messages with photos")
+    p.add_argument("--webpages", type=float, default=0.05, help="fraction of messages with link previews")
+    p.add_argument("--polls", type=float, default=0.01, help="fraction of messages with polls")
+    p.add_argument("--replies", type=float, default=0.2, help="fraction of messages that are replies")
+    p.add_argument("--edits", type=float, default=0.05, help="fraction of messages that are edited")
+    p.add_argument("--seed", type=int, default=1, help="random seed")
+    args = p.parse_args()
+
+    generate(args.path, args.messages, args.users, args.months, args.photos, args.webpages,
+             args.polls, args.replies, args.edits, args.seed)
+    logging.info("generated {} messages in '{}'".format(args.messages, args.path))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Run the benchmarks on a synthetic archive and write the timings as JSON,
+to compare the performance across commits.
+
+    python -m benchmarks.run --messages 100000 --output before.json
+    python -m benchmarks.run --messages 100000 --compare before.json
+
+Each benchmark is run --repeat times and the fastest run is reported
+along with the throughput (items per second).
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import timedelta
+
+from tgarchive import _CONFIG, __version__
+from tgarchive.db import DB, Message, _messages_query
+
+from .generate import generate, make_users
+
+_EXAMPLE_DIR = os.path.join(os.path.dirname(__file__), "..", "tgarchive", "example")
+
+BENCHMARKS = ["db.get_timeline", "db.get_dayline", "db.get_messages", "db.make_message",
+              "build.full", "build.incremental", "build.append", "build.rss", "sync.ingest",
+              "watch.update"]
+
+
+def _time(fn, repeat, setup=None) -> list:
+    """Time fn() repeat times (after setup(), which isn't timed)."""
+    runs = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return runs
+
+
+def _commit() -> str:
+    """The git commit of the working tree, marked if it has uncommitted changes."""
+    try:
+        cwd = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=cwd,
+                                         stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"],
+                                        cwd=cwd, stderr=subprocess.DEVNULL, text=True).strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Runner:
+    def __init__(self, args, dir):
+        self.args = args
+        self.dir = dir
+        self.dbfile = os.path.join(dir, "data.sqlite")
+        self.config = {**_CONFIG,
+                       "group": "benchmark",
+                       "timezone": args.timezone,
+                       "per_page": args.per_page,
+                       "publish_nav_include": args.nav_include,
+                       "publish_dir": os.path.join(dir, "site"),
+                       "static_dir": os.path.join(_EXAMPLE_DIR, "static"),
+                       "media_dir": os.path.join(dir, "media"),
+                       "download_avatars": False,
+                       "download_media": False,
+                       "fetch_wait": 0}
+
+        self.db = None
+        self.timeline = []
+
+    def setup(self):
+        a = self.args
+        generate(self.dbfile, a.messages, a.users, a.months, a.photos, a.webpages,
+                 a.polls, a.replies, seed=a.seed)
+        self.db = DB(self.dbfile, self.config["timezone"])
+        self.timeline = list(self.db.get_timeline())
+
+    def run(self, names) -> dict:
+        results = {}
+        for name in names:
+            items, runs = getattr(self, "bench_" + name.replace(".", "_"))()
+            best = min(runs)
+            results[name] = {"seconds": best,
+                             "mean": sum(runs) / len(runs),
+                             "runs": runs,
+                             "items": items,
+                             "items_per_second": items / best if best else None}
+            print("{:<20} {:>10.4f}s {:>14.0f}/s".format(
+                name, best, results[name]["items_per_second"] or 0), file=sys.stderr)
+        return results
+
+    def bench_db_get_timeline(self):
+        return len(self.timeline), _time(lambda: list(self.db.get_timeline()), self.args.repeat)
+
+    def bench_db_get_dayline(self):
+        def fn():
+            for m in self.timeline:
+                list(self.db.get_dayline(m.date.year, m.date.month, self.args.per_page))
+        return len(self.timeline), _time(fn, self.args.repeat)
+
+    def bench_db_get_messages(self):
+        def fn():
+            for m in self.timeline:
+                list(self.db.get_messages(m.date.year, m.date.month, 0, m.count))
+        return self.args.messages, _time(fn, self.args.repeat)
+
+    def bench_db_make_message(self):
+        # Only the conversion of the rows, which are fetched upfront.
+        rows = self.db.conn.cursor().execute(_messages_query + " ORDER BY messages.id").fetchall()
+        return len(rows), _time(lambda: [self.db._make_message(r) for r in rows], self.args.repeat)
+
+    def _new_build(self, full):
+        from tgarchive.build import Build
+
+        b = Build(self.config, self.db, False, full)
+        b.load_template(os.path.join(_EXAMPLE_DIR, "template.html"))
+        return b
+
+    def bench_build_full(self):
+        return self.args.messages, _time(lambda: self._new_build(True).build(), self.args.repeat)
+
+    def bench_build_incremental(self):
+        # A rebuild without any changes since the last build.
+        def setup():
+            if not os.path.exists(self.config["publish_dir"]):
+                self._new_build(True).build()
+        return self.args.messages, _time(lambda: self._new_build(False).build(),
+                                         self.args.repeat, setup)
+
+    def bench_build_append(self):
+        # A rebuild after new messages were added to the latest month, eg: by a nightly sync.
+        a = self.args
+        last_id, date = self.db.get_last_message_id()
+        users = make_users(a.users, a.seed)
+        new = [Message(id=last_id + i, type="message", date=date + timedelta(seconds=i),
+                       edit_date=None, content="appended message {}".format(i), reply_to=None,
+                       user=users[i % len(users)], media=None)
+               for i in range(1, a.append + 1)]
+
+        def setup():
+            self.db.delete_messages([m.id for m in new])
+            self._new_build(False).build()
+            self.db.insert_messages(new)
+
+        runs = _time(lambda: self._new_build(False).build(), a.repeat, setup)
+        self.db.delete_messages([m.id for m in new])
+        return a.append, runs
+
+    def bench_build_rss(self):
+        # A build maps the message IDs to pages, which the feed links to.
+        b = self._new_build(True)
+        b.build()
+
+        entries, n = [], self.config["rss_feed_entries"]
+        for m in reversed(self.timeline):
+            if len(entries) >= n:
+                break
+            entries = list(self.db.get_messages(m.date.year, m.date.month, 0, m.count)) + entries
+        entries = entries[-n:]
+
+        return len(entries), _time(lambda: b._build_rss(entries, "index.rss", "index.atom"),
+                                   self.args.repeat)
+
+    def bench_sync_ingest(self):
+        from tgarchive.sync import Sync
+        from .fake_client import FakeClient
+
+        a = self.args
+        client = FakeClient(a.messages, a.users, a.photos, a.webpages, a.polls, a.replies,
+                            a.latency, a.seed)
+        dbfile = os.path.join(self.dir, "sync.sqlite")
+        state = {}
+
+        def setup():
+            if os.path.exists(dbfile):
+                os.remove(dbfile)
+            state["sync"] = Sync(self.config, None, DB(dbfile), client=client)
+
+        return a.messages, _time(lambda: state["sync"].sync(), a.repeat, setup)
+
+    def bench_watch_update(self):
+        # Time from a new message to the rebuilt site in --watch: the message is
+        # fetched and written as an update and the site is rebuilt, which has to
+        # only re-render the month it's in (with the timeline published once).
+        from tgarchive.build import Build
+        from tgarchive.sync import Sync
+        from .fake_client import FakeClient
+
+        a = self.args
+        config = {**self.config,
+                  "publish_dir": os.path.join(self.dir, "watch_site"),
+                  "publish_nav_include": True}
+        client = FakeClient(a.messages, a.users, a.photos, a.webpages, a.polls, a.replies,
+                            0, a.seed)
+        dbfile = os.path.join(self.dir, "watch.sqlite")
+        sync = Sync(config, None, DB(dbfile), client=client)
+        sync.sync()
+        group = sync._get_group(config["group"])
+
+        db = DB(dbfile, config["timezone"])
+        state = {}
+
+        def build():
+            b = Build(config, db, False)
+            b.load_template(os.path.join(_EXAMPLE_DIR, "template.html"))
+            b.build()
+            state["rendered"] = b.rendered
+
+        def update():
+            sync._apply_updates(group, [client.add_message()], [])
+            build()
+
+        build()
+        runs = _time(update, a.repeat)
+        if len(state["rendered"]) != 1:
+            raise AssertionError("a new message re-rendered {} months instead of 1".format(
+                len(state["rendered"])))
+        return 1, runs
+
+
+def _compare(old, new):
+    """Print the ratio of the new timings to the old ones (<1 is faster)."""
+    print("{:<20} {:>10} {:>10} {:>8}".format("benchmark", "old", "new", "ratio"), file=sys.stderr)
+    for name, r in new["results"].items():
+        o = old["results"].get(name)
+        if not o:
+            continue
+        print("{:<20} {:>9.4f}s {:>9.4f}s {:>8.2f}".format(
+            name, o["seconds"], r["seconds"], r["seconds"] / o["seconds"] if o["seconds"] else 0),
+            file=sys.stderr)
+
+
+def main():
+    p = argparse.ArgumentParser(
+        description="Benchmark tg-archive on a synthetic archive.",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    p.add_argument("--messages", type=int, default=10000, help="number of messages")
+    p.add_argument("--users", type=int, default=100, help="number of users")
+    p.add_argument("--months", type=int, default=12, help="number of months to spread the messages over")
+    p.add_argument("--photos", type=float, default=0.1, help="fraction of messages with photos")
+    p.add_argument("--webpages", type=float, default=0.05, help="fraction of messages with link previews")
+    p.add_argument("--polls", type=float, default=0.01, help="fraction of messages with polls")
+    p.add_argument("--replies", type=float, default=0.2, help="fraction of messages that are replies")
+    p.add_argument("--seed", type=int, default=1, help="random seed")
+    p.add_argument("--per-page", type=int, default=1000, dest="per_page", help="messages per page")
+    p.add_argument("--nav-include", action="store_true", dest="nav_include",
+                   help="publish the timeline once instead of into every page (publish_nav_include)")
+    p.add_argument("--timezone", type=str, default="", help="timezone of the site (eg: Europe/London)")
+    p.add_argument("--append", type=int, default=100, help="number of messages added for build.append")
+    p.add_argument("--latency", type=float, default=0, help="seconds per request of the fake Telegram client")
+    p.add_argument("--repeat", type=int, default=3, help="number of runs of each benchmark")
+    p.add_argument("--only", type=str, nargs="+", choices=BENCHMARKS, help="benchmarks to run")
+    p.add_argument("--output", type=str, default="-", help="file to write the JSON results to")
+    p.add_argument("--compare", type=str, help="JSON results of an earlier run to compare with")
+    p.add_argument("--keep", action="store_true", help="keep the generated archive and site")
+    args = p.parse_args()
+
+    # The sync and build log every batch and page.
+    logging.getLogger().setLevel(logging.WARNING)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+
+    dir = tempfile.mkdtemp(prefix="tg-archive-bench-")
+    try:
+        r = Runner(args, dir)
+        r.setup()
+        out = {"version": __version__,
+               "commit": _commit(),
+               "python": platform.python_version(),
+               "platform": platform.platform(),
+               "params": vars(args),
+               "results": r.run(args.only or BENCHMARKS)}
+    finally:
+        if args.keep:
+            print("archive and site kept in '{}'".format(dir), file=sys.stderr)
+        else:
+            shutil.rmtree(dir, ignore_errors=True)
+
+    if args.output == "-":
+        json.dump(out, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(out, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            _compare(json.load(f), out)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,9 @@
 import argparse
+import atexit
 import logging
 import os
 import shutil
+import sqlite3
 import sys
 import yaml
 
@@ -21,17 +23,51 @@ _CONFIG = {
     "download_media": False,
     "media_dir": "media",
     "media_mime_types": [],
+    # Number of media files to download at a time.
+    "media_concurrency": 4,
+    # Skip media files larger than this (MB). 0 for no limit.
+    "media_max_size": 0,
+    "media_thumb_size": [320, 320],
     "proxy": {
         "enable": False,
     },
+    # Maximum messages per batch and the initial seconds between batches.
+    # Both are adapted to flood waits during the sync.
     "fetch_batch_size": 2000,
     "fetch_wait": 5,
     "fetch_limit": 0,
+    # Maximum number of fetch requests made at a time (eg: by --segments
+    # or when syncing several groups).
+    "fetch_concurrency": 4,
+    # Groups to sync at once with --sync instead of "group", each with its DB
+    # file and media directory (<group>.sqlite and <group>_media by default)
+    # and optionally any other config overrides, eg:
+    # [{"group": "mygroup", "data": "mygroup.sqlite", "media_dir": "mygroup_media"}]
+    "groups": [],
+    # Seconds to wait for updates to settle before rebuilding in --watch.
+    "watch_debounce": 5,
+    # Use a write-ahead log without fsync on every commit for faster imports.
+    # The DB switches back to its previous journal mode when the sync finishes,
+    # but stays in WAL mode (with -wal and -shm files next to it) if the sync
+    # is interrupted, until a later sync with bulk_import finishes.
+    "bulk_import": False,
 
     "publish_rss_feed": True,
     "rss_feed_entries": 100,
+    "publish_search_index": False,
+    # Write .gz (and .br with brotli installed) copies of the published
+    # pages, feeds and indexes for servers to serve as is (eg: gzip_static).
+    "publish_compressed": False,
+    # Publish the sidebar timeline once as timeline.html for static/main.js
+    # to load into the pages, and draw the pagination in main.js, instead of
+    # rendering them into every page. Needs JavaScript to navigate the site.
+    "publish_nav_include": False,
 
     "publish_dir": "site",
+    # How static and media files are published when not symlinked:
+    # copy, hardlink or reflink. Links fall back to copying when they
+    # aren't supported by the filesystem.
+    "publish_link": "copy",
     "site_url": "https://mysite.com",
     "static_dir": "static",
     "telegram_url": "https://t.me/{id}",
@@ -52,6 +88,34 @@ def get_config(path):
     return config
 
 
+def _start_profiling(args, command):
+    """
+    Record the metrics of the run (and profile it with cProfile) and write
+    them to the files in args when the process exits.
+    """
+    from .metrics import metrics
+
+    metrics.enable()
+
+    prof = None
+    if args.profile:
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+
+    def finish():
+        if prof:
+            prof.disable()
+            prof.dump_stats(args.profile)
+            logging.info("wrote profile to '{}'".format(args.profile))
+
+        if args.metrics_file:
+            metrics.write(args.metrics_file, command)
+            logging.info("wrote metrics to '{}'".format(args.metrics_file))
+
+    atexit.register(finish)
+
+
 def main():
     """Run the CLI."""
     p = argparse.ArgumentParser(
@@ -79,6 +143,14 @@ def main():
                    dest="id", help="sync (or update) messages for given ids")
     s.add_argument("-from-id", "--from-id", action="store", type=int,
                    dest="from_id", help="sync (or update) messages from this id to the latest")
+    s.add_argument("--segments", action="store", type=int, default=1, dest="segments",
+                   help="backfill the history up to the latest message in this many segments "
+                   "fetched concurrently (for large first syncs, eg: with use_takeout)")
+    s.add_argument("--media-only", action="store_true", dest="media_only",
+                   help="only download the media that is pending or failed in the local DB")
+    s.add_argument("--watch", action="store_true", dest="watch",
+                   help="sync and build, and then keep syncing new, edited and deleted "
+                   "messages as they happen and rebuild the changed pages (runs until stopped)")
 
     b = p.add_argument_group("build")
     b.add_argument("-b", "--build", action="store_true",
@@ -89,9 +161,34 @@ def main():
                    dest="rss_template", help="path to the rss template file")
     b.add_argument("--symlink", action="store_true", dest="symlink",
                    help="symlink media and other static files instead of copying")
+    b.add_argument("--full", action="store_true", dest="full",
+                   help="rebuild the whole site instead of only the months that have changed")
+    b.add_argument("--workers", action="store", type=int, default=1, dest="workers",
+                   help="number of processes to render pages with")
+    b.add_argument("--backfill-media", action="store_true", dest="backfill_media",
+                   help="record the size and type of media files downloaded by older versions")
+
+    q = p.add_argument_group("search")
+    q.add_argument("--search", action="store", type=str, dest="search",
+                   help="search messages in the local DB (SQLite FTS5 query syntax)")
+    q.add_argument("--search-limit", action="store", type=int, default=20,
+                   dest="search_limit", help="maximum number of search results")
+
+    m = p.add_argument_group("profile")
+    m.add_argument("--metrics-file", action="store", type=str, dest="metrics_file",
+                   help="write the time spent in each phase of the sync or build, with counts, "
+                   "throughput and peak memory, to this file as JSON (or in the Prometheus "
+                   "text format if it ends with .prom)")
+    m.add_argument("--profile", action="store", type=str, dest="profile",
+                   help="write a cProfile dump of the whole run to this file")
 
     args = p.parse_args(args=None if sys.argv[1:] else ['--help'])
 
+    if args.metrics_file or args.profile:
+        command = next((c for c in ("watch", "sync", "search", "backfill_media", "build")
+                        if getattr(args, c)), "")
+        _start_profiling(args, command)
+
     if args.version:
         print("v{}".format(__version__))
         sys.exit()
@@ -123,9 +220,9 @@ def main():
                 os.chmod(os.path.join(root, f), 0o644)
 
     # Sync from Telegram.
-    elif args.sync:
+    elif args.sync or args.watch:
         # Import because the Telegram client import is quite heavy.
-        from .sync import Sync
+        from .sync import Sync, sync_groups
 
         # Ensure an asyncio event loop exists (fixes RuntimeError on Python 3.11+)
         import asyncio
@@ -141,12 +238,68 @@ def main():
         cfg = get_config(args.config)
         mode = "takeout" if cfg.get("use_takeout", False) else "standard"
 
+        if args.watch and mode == "takeout":
+            logging.error("--watch does not work with use_takeout")
+            sys.exit(1)
+
         logging.info("starting Telegram sync (batch_size={}, limit={}, wait={}, mode={})".format(
             cfg["fetch_batch_size"], cfg["fetch_limit"], cfg["fetch_wait"], mode
         ))
+        if cfg["groups"] and (args.watch or args.media_only or args.id or args.from_id or
+                              args.segments > 1):
+            logging.error("--watch, --media-only, --id, --from-id and --segments "
+                          "work with a single group but not with groups")
+            sys.exit(1)
+
         try:
-            s = Sync(cfg, args.session, DB(args.data))
-            s.sync(args.id, args.from_id)
+            # Sync several groups at once over the same client.
+            if cfg["groups"]:
+                # Media files are named by message ID, which every group numbers
+                # from 1, so the groups can't download into the same directory.
+                gcfgs = [{**cfg,
+                          "data": "{}.sqlite".format(g["group"]),
+                          "media_dir": "{}_media".format(g["group"]),
+                          **g} for g in cfg["groups"]]
+                dirs = [os.path.abspath(g["media_dir"]) for g in gcfgs if g["download_media"]]
+                if len(set(dirs)) != len(dirs):
+                    logging.error("groups that download media need different media_dir's")
+                    sys.exit(1)
+
+                syncs = []
+                for gcfg in gcfgs:
+                    db = DB(gcfg["data"])
+                    if gcfg["bulk_import"]:
+                        db.set_bulk_mode()
+                    syncs.append(Sync(gcfg, args.session, db, share=syncs[0] if syncs else None))
+
+                s = syncs[0]
+                sync_groups(syncs)
+                for sync in syncs:
+                    sync.db.end_bulk_mode()
+            else:
+                db = DB(args.data)
+                if cfg["bulk_import"]:
+                    db.set_bulk_mode()
+
+                s = Sync(cfg, args.session, db)
+                if args.watch:
+                    from .build import Build
+                    bdb = DB(args.data, cfg["timezone"])
+
+                    def build():
+                        b = Build(cfg, bdb, args.symlink, workers=args.workers)
+                        b.load_template(args.template)
+                        if args.rss_template:
+                            b.load_rss_template(args.rss_template)
+                        if b.build():
+                            logging.info("published to directory '{}'".format(cfg["publish_dir"]))
+
+                    s.watch(build)
+                elif args.media_only:
+                    s.sync_media()
+                else:
+                    s.sync(args.id, args.from_id, args.segments)
+                db.end_bulk_mode()
         except KeyboardInterrupt as e:
             logging.info("sync cancelled manually")
             if cfg.get("use_takeout", False):
@@ -155,16 +308,44 @@ def main():
         except:
             raise
 
+    # Search the local DB.
+    elif args.search:
+        from .build import Build
+
+        config = get_config(args.config)
+        db = DB(args.data, config["timezone"])
+        b = Build(config, db, False)
+
+        try:
+            for r in db.search(args.search, config["per_page"], args.search_limit):
+                print("{}/{}#{}  @{}, {}".format(config["site_url"],
+                                                 b.make_filename(r.month, r.page),
+                                                 r.message.id,
+                                                 r.message.user.username,
+                                                 r.message.date.strftime("%Y-%m-%d %H:%M")))
+                print("    {}\n".format(" ".join(r.snippet.split())))
+        except sqlite3.OperationalError as e:
+            logging.error("invalid search query: {}".format(e))
+            sys.exit(1)
+
+    # Describe existing media files.
+    elif args.backfill_media:
+        from .build import Build
+
+        config = get_config(args.config)
+        Build(config, DB(args.data), False).backfill_media()
+
     # Build static site.
     elif args.build:
         from .build import Build
 
         logging.info("building site")
         config = get_config(args.config)
-        b = Build(config, DB(args.data, config["timezone"]), args.symlink)
+        b = Build(config, DB(args.data, config["timezone"]), args.symlink, args.full, args.workers)
         b.load_template(args.template)
         if args.rss_template:
             b.load_rss_template(args.rss_template)
-        b.build()
+        if not b.build():
+            sys.exit()
 
         logging.info("published to directory '{}'".format(config["publish_dir"]))
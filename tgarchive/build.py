@@ -1,131 +1,753 @@
+from array import array
+from bisect import bisect_left, bisect_right
 from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, islice
+import gzip
+import hashlib
+import json
 import logging
 import math
 import os
 import pkg_resources
 import re
 import shutil
+import stat
+import unicodedata
+import zlib
 import magic
 
 from feedgen.feed import FeedGenerator
-from jinja2 import Template
+from jinja2 import (ChoiceLoader, DictLoader, Environment, FileSystemBytecodeCache,
+                    FileSystemLoader, Template, TemplateNotFound, meta)
+from markupsafe import Markup
+from PIL import Image
 
-from .db import User, Message
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+from .db import DB, User, Message, Month
+from .metrics import metrics
+from .__metadata__ import __version__
 
 
 _NL2BR = re.compile(r"\n\n+")
 
+# The state kept between builds is written to a directory next to the DB
+# (<data file>.build), outside of publish_dir so that it isn't published:
+# the manifest to find the months that have changed since the last build,
+# and the search terms of every month. The manifest format is also bumped to
+# rebuild sites (and the cached search terms) from scratch when the output
+# changes incompatibly, eg: the tokenization of search terms.
+_STATE_DIR = "{}.build"
+_MANIFEST = "manifest.json"
+_MANIFEST_FORMAT = 5
+
+# Sidebar timeline published once for all pages with publish_nav_include.
+_TIMELINE_FILE = "timeline.html"
+
+# Size of the write buffer of the pages that templates are streamed into.
+_PAGE_BUFFER = 256 * 1024
+
+# Number of template output strings joined into each chunk that's written.
+_STREAM_CHUNK = 1000
+
+# Directory of the published search index shards, and the directory
+# of the per-month search terms in the build state.
+_SEARCH_DIR = "search"
+_SEARCH_CACHE_DIR = "search"
+
+# Words in messages that are indexed for search: letters, digits and
+# combining marks (compiled on first use). This has to match tokenize()
+# in static/search.js.
+_WORDS = None
+
+# Maximum number of [page index, message ID] items in a search index
+# shard before it's split into the shards of longer prefixes.
+_SHARD_SIZE = 20000
+
+
+# Published files that are precompressed for web servers to serve as is.
+_COMPRESS_EXTS = (".html", ".css", ".js", ".json", ".xml", ".rss", ".atom", ".svg", ".txt")
+
+# ioctl that clones a file's extents on copy-on-write filesystems
+# (Btrfs, XFS) on Linux.
+_FICLONE = 0x40049409
+
+
+def _remove(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def _reflink(src, dst):
+    """Clone src to dst without copying its data. Returns False if unsupported."""
+    try:
+        import fcntl
+    except ImportError:
+        return False
+
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        try:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+            return True
+        except OSError:
+            pass
+
+    os.remove(dst)
+    return False
+
+
+def _mark_ranges() -> str:
+    """
+    Regex character class ranges of all combining marks (Unicode category M),
+    which aren't word characters for re, eg: the vowel signs of Devanagari.
+    Marks are only in the first two planes and in the variation selectors
+    of plane 14.
+    """
+    out, start = [], None
+    for c in chain(range(0x20000), range(0xE0000, 0xE1000), [-1]):
+        if c >= 0 and unicodedata.category(chr(c))[0] == "M":
+            if start is None:
+                start = c
+        elif start is not None:
+            out.append(re.escape(chr(start)) + "-" + re.escape(chr(prev)))
+            start = None
+        prev = c
+    return "".join(out)
+
+
+def _tokenize(text):
+    global _WORDS
+    if _WORDS is None:
+        _WORDS = re.compile(r"[\w{}]{{2,}}".format(_mark_ranges()))
+    return _WORDS.findall(unicodedata.normalize("NFC", text.lower()))
+
+
+def _shard_name(term, n=2) -> str:
+    """Name of the search index shard of a term: its first n code points in hex."""
+    return "-".join("{:x}".format(ord(c)) for c in term[:n])
+
+
+def _split_shards(shards) -> dict:
+    """
+    Split the shards of two character prefixes that have more than
+    _SHARD_SIZE items into the shards of longer prefixes, recursively.
+    A split shard keeps the terms that are as long as its prefix and
+    lists the names of its sub-shards under the "" key.
+    """
+    out = {}
+    todo = [(name, terms, 2) for name, terms in shards.items()]
+    while todo:
+        name, terms, n = todo.pop()
+        if sum(len(p) for p in terms.values()) <= _SHARD_SIZE * 2:
+            out[name] = terms
+            continue
+
+        shard, subs = {}, {}
+        for t, p in terms.items():
+            if len(t) > n:
+                subs.setdefault(_shard_name(t, n + 1), {})[t] = p
+            else:
+                shard[t] = p
+
+        if not subs:
+            out[name] = terms
+            continue
+
+        shard[""] = sorted(subs)
+        out[name] = shard
+        todo.extend((s, t, n + 1) for s, t in subs.items())
+
+    return out
+
+
+class _PageIndex:
+    """
+    Compact map of message IDs -> filenames of the pages they're published
+    on. The IDs are kept in a sorted array (8 bytes per message) that's
+    split into runs of consecutive IDs that are on the same page, and
+    looked up by binary search. Like a dict, a missing ID raises KeyError
+    (which templates render as empty).
+    """
+
+    def __init__(self):
+        self._ids = array("q")
+
+        # Positions in _ids at which the runs start and the page of each run.
+        self._runs = array("q")
+        self._run_pages = array("l")
+        self._pages = []
+
+        self._sorted = True
+
+    def add_page(self, fname, ids):
+        """Add a page with the IDs of its messages in ascending order."""
+        n = len(self._ids)
+        self._ids.extend(ids)
+        if len(self._ids) == n:
+            return
+
+        if n and self._ids[n] < self._ids[n - 1]:
+            self._sorted = False
+
+        self._runs.append(n)
+        self._run_pages.append(len(self._pages))
+        self._pages.append(fname)
+
+    def finish(self):
+        """
+        Sort the IDs if the pages weren't added in the order of their IDs,
+        eg: if messages aren't in chronological order of their IDs.
+        """
+        if self._sorted:
+            return
+
+        pages = array("l")
+        for i, (start, page) in enumerate(zip(self._runs, self._run_pages)):
+            end = self._runs[i + 1] if i + 1 < len(self._runs) else len(self._ids)
+            pages.extend([page] * (end - start))
+
+        order = sorted(range(len(self._ids)), key=self._ids.__getitem__)
+        self._ids = array("q", (self._ids[i] for i in order))
+        self._runs, self._run_pages = array("q"), array("l")
+        for n, i in enumerate(order):
+            if not n or pages[i] != self._run_pages[-1]:
+                self._runs.append(n)
+                self._run_pages.append(pages[i])
+
+        self._sorted = True
+
+    def get(self, id, default=None):
+        i = bisect_left(self._ids, id)
+        if i == len(self._ids) or self._ids[i] != id:
+            return default
+        return self._pages[self._run_pages[bisect_right(self._runs, i) - 1]]
+
+    def __getitem__(self, id):
+        fname = self.get(id)
+        if fname is None:
+            raise KeyError(id)
+        return fname
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def __len__(self):
+        return len(self._ids)
+
 
 class Build:
     config = {}
     template = None
     db = None
 
-    def __init__(self, config, db, symlink):
+    def __init__(self, config, db, symlink, full=False, workers=1):
         self.config = config
         self.db = db
         self.symlink = symlink
 
+        # Ignore the manifest of the last build and rebuild everything.
+        self.full = full
+
+        # Number of processes to render pages with.
+        self.workers = workers
+
+        # Directory of the state kept between builds of the DB.
+        self.state_dir = _STATE_DIR.format(db.dbfile)
+
+        # Sources of the templates and the templates they include, import or
+        # extend (by their names relative to the template directories), which
+        # the build output depends on. The templates are compiled from them by
+        # a Jinja environment whose bytecode is cached across runs.
+        self.sources = {}
+        self.template_names = {}
+        self.template_dirs = []
+        self.env = Environment(loader=self._make_loader(), autoescape=True,
+                               bytecode_cache=FileSystemBytecodeCache())
+
         self.rss_template: Template = None
 
         # Map of all message IDs across all months and the slug of the page
         # in which they occur (paginated), used to link replies to their
         # parent messages that may be on arbitrary pages.
-        self.page_ids = {}
+        self.page_ids = _PageIndex()
         self.timeline = OrderedDict()
 
-    def build(self):
-        # (Re)create the output directory.
-        self._create_publish_dir()
+        # Slugs of the months (re-)rendered by the last build().
+        self.rendered = []
 
+    def build(self) -> bool:
+        """Build the site. Returns False if there are no messages to publish."""
         timeline = list(self.db.get_timeline())
         if len(timeline) == 0:
             logging.info("no data found to publish site")
-            quit()
+            return False
 
         for month in timeline:
             if month.date.year not in self.timeline:
                 self.timeline[month.date.year] = []
             self.timeline[month.date.year].append(month)
 
-        # Queue to store the latest N items to publish in the RSS feed.
-        rss_entries = deque([], self.config["rss_feed_entries"])
-        fname = None
-        for month in timeline:
-            # Get the days + message counts for the month.
-            dayline = OrderedDict()
-            for d in self.db.get_dayline(month.date.year, month.date.month, self.config["per_page"]):
-                dayline[d.slug] = d
-
-            # Paginate and fetch messages for the month until the end..
-            page = 0
-            last_id = 0
-            total = self.db.get_message_count(
-                month.date.year, month.date.month)
-            total_pages = math.ceil(total / self.config["per_page"])
-
-            while True:
-                messages = list(self.db.get_messages(month.date.year, month.date.month,
-                                                     last_id, self.config["per_page"]))
-
-                if len(messages) == 0:
-                    break
+        # Compare the fingerprints of the months against the manifest of the
+        # last build to find the months that have to be re-rendered. A change
+        # to the templates or config (or to the timeline, if it's rendered into
+        # every page) makes all months stale. Without a usable manifest, do a
+        # clean build.
+        manifest = self._make_manifest(timeline)
+        last = None if self.full else self._load_manifest()
+        clean = last is None
+        if last and last["site"] != manifest["site"]:
+            last["months"] = {}
+
+        # (Re)create the output directory.
+        with metrics.phase("build.publish_dir"):
+            self._create_publish_dir(clean)
+
+        # Map the IDs of all messages to their pages upfront so that replies
+        # can link to their parents in any month, including later ones.
+        with metrics.phase("build.page_ids") as p:
+            manifest["pages"], moved = self._map_pages(timeline, last)
+            p.items = len(self.page_ids)
+
+        # Months with replies to messages that have moved to another page
+        # since the last build have to be re-rendered to update their links.
+        replying = self.db.get_replying_months(moved) if moved and not clean else set()
 
-                last_id = messages[-1].id
+        # Publish the timeline that static/main.js loads into the pages.
+        self._publish_timeline()
 
-                page += 1
-                fname = self.make_filename(month, page)
+        # Render the months that have changed since the last build.
+        stale = []
+        for month in timeline:
+            fp = manifest["months"][month.slug]
+            if clean or fp is None or last["months"].get(month.slug) != fp or \
+                    month.slug in replying or not os.path.exists(
+                        os.path.join(self.config["publish_dir"], self.make_filename(month, 1))):
+                stale.append(month)
 
-                # Collect the message ID -> page name for all messages in the set
-                # to link to replies in arbitrary positions across months, paginated pages.
-                for m in messages:
-                    self.page_ids[m.id] = fname
+        with metrics.phase("build.render", sum(m.count for m in stale)):
+            if self.workers > 1 and len(stale) > 1:
+                self._render_parallel(stale)
+            else:
+                for month in stale:
+                    self._render_month(month)
 
-                if self.config["publish_rss_feed"]:
-                    rss_entries.extend(messages)
+        # Remove the pages of months that have shrunk or disappeared since the last build.
+        if not clean:
+            self._remove_stale_pages(last, timeline)
 
-                self._render_page(messages, month, dayline,
-                                  fname, page, total_pages)
+        self.rendered = [m.slug for m in stale]
+        logging.info("rendered {} of {} months".format(len(stale), len(timeline)))
 
         # The last page chronologically is the latest page. Make it index.
-        if fname:
-            if self.symlink:
-                os.symlink(fname, os.path.join(self.config["publish_dir"], "index.html"))
-            else:
-                shutil.copy(os.path.join(self.config["publish_dir"], fname),
-                            os.path.join(self.config["publish_dir"], "index.html"))
+        fname = self.make_filename(timeline[-1], self._total_pages(timeline[-1]))
+        index = os.path.join(self.config["publish_dir"], "index.html")
+        if os.path.lexists(index):
+            os.remove(index)
+
+        if self.symlink:
+            os.symlink(fname, index)
+        else:
+            shutil.copy(os.path.join(self.config["publish_dir"], fname), index)
 
-        # Generate RSS feeds.
+        # Generate RSS feeds from the latest N messages, which are in the last month(s).
         if self.config["publish_rss_feed"]:
-            self._build_rss(rss_entries, "index.rss", "index.atom")
+            months, n = [], 0
+            for month in reversed(timeline):
+                if n >= self.config["rss_feed_entries"]:
+                    break
+                months.insert(0, month)
+                n += month.count
+
+            rss_entries = deque([], self.config["rss_feed_entries"])
+            for month in months:
+                rss_entries.extend(self.db.get_messages(month.date.year, month.date.month,
+                                                        0, month.count))
+
+            with metrics.phase("build.rss", len(rss_entries)):
+                self._build_rss(rss_entries, "index.rss", "index.atom")
+
+        # Merge the search terms of all months into the published shards.
+        if self.config["publish_search_index"]:
+            with metrics.phase("build.search_index"):
+                self._build_search_index(timeline)
+
+        if self.config["publish_compressed"]:
+            with metrics.phase("build.compress"):
+                self._compress()
+
+        self._save_manifest(manifest)
+        return True
 
     def load_template(self, fname):
-        with open(fname, "r") as f:
-            self.template = Template(f.read(), autoescape=True)
+        self.template = self._load_template("template", fname)
 
     def load_rss_template(self, fname):
-        with open(fname, "r") as f:
-            self.rss_template = Template(f.read(), autoescape=True)
+        self.rss_template = self._load_template("rss_template", fname)
+
+    def load_sources(self, sources, names, dirs):
+        """Compile the templates from the sources of another Build."""
+        self.sources = dict(sources)
+        self.template_names = dict(names)
+        self.template_dirs = list(dirs)
+        self.env.loader = self._make_loader()
+
+        if "template" in names:
+            self.template = self.env.get_template(names["template"])
+        if "rss_template" in names:
+            self.rss_template = self.env.get_template(names["rss_template"])
+
+    def _load_template(self, kind, fname) -> Template:
+        """
+        Read a template and the templates it includes, imports or extends
+        from its directory, and compile it. Templates that are only named
+        at render time (eg: {% include var %}) are loaded from the template
+        directories as they're rendered. Templates are named relative to
+        their directories, so a template in this directory that has the name
+        of a different one already loaded from another directory is refused.
+        """
+        dir, name = os.path.split(os.path.abspath(fname))
+        if dir not in self.template_dirs:
+            self.template_dirs.append(dir)
+        self.template_names[kind] = name
+
+        files = FileSystemLoader(dir)
+        names = [name]
+        while names:
+            n = names.pop()
+            try:
+                src, path, _ = files.get_source(self.env, n)
+            except TemplateNotFound:
+                if n in self.sources:
+                    continue
+                raise
+
+            if n in self.sources:
+                if src != self.sources[n]:
+                    raise ValueError("template '{}' has the same name as a different "
+                                     "template in another directory".format(path))
+                continue
+
+            self.sources[n] = src
+            names.extend(t for t in meta.find_referenced_templates(self.env.parse(src)) if t)
+
+        self.env.loader = self._make_loader()
+        return self.env.get_template(name)
+
+    def _make_loader(self):
+        return ChoiceLoader([DictLoader(self.sources), FileSystemLoader(self.template_dirs)])
+
+    def _map_pages(self, timeline, last) -> [dict, list]:
+        """
+        Map the IDs of all messages to their pages in page_ids. Returns the
+        layout of the pages of every month, [[message count, checksum of the
+        IDs], ...], and the [first, last] ID ranges of the pages whose layout
+        has changed since the last build (merged where they're adjacent), ie:
+        of the messages that may have moved to another page. Messages that
+        were only appended to a page haven't moved. Without a last build,
+        nothing is compared and no ranges are returned.
+        """
+        layout, moved = {}, []
+        for month in timeline:
+            ids = self.db.get_message_ids(month.date.year, month.date.month)
+            old = last["pages"].get(month.slug, []) if last else []
+
+            pages, prev = [], False
+            for page in range(1, self._total_pages(month) + 1):
+                pids = array("q", islice(ids, self.config["per_page"]))
+                self.page_ids.add_page(self.make_filename(month, page), pids)
+
+                crc = zlib.crc32(pids)
+                pages.append([len(pids), crc])
+                if last is None or not pids:
+                    continue
+                if page <= len(old):
+                    n, c = old[page - 1]
+                    if (n == len(pids) and c == crc) or \
+                            (n < len(pids) and zlib.crc32(pids[:n]) == c):
+                        prev = False
+                        continue
+
+                if prev:
+                    moved[-1][1] = pids[-1]
+                else:
+                    moved.append([pids[0], pids[-1]])
+                prev = True
+
+            layout[month.slug] = pages
+
+        self.page_ids.finish()
+        return layout, moved
 
     def make_filename(self, month, page) -> str:
         fname = "{}{}.html".format(
             month.slug, "_" + str(page) if page > 1 else "")
         return fname
 
-    def _render_page(self, messages, month, dayline, fname, page, total_pages):
-        html = self.template.render(config=self.config,
-                                    timeline=self.timeline,
-                                    dayline=dayline,
-                                    month=month,
-                                    messages=messages,
-                                    page_ids=self.page_ids,
-                                    pagination={"current": page,
-                                                "total": total_pages},
-                                    make_filename=self.make_filename,
-                                    nl2br=self._nl2br)
-
-        with open(os.path.join(self.config["publish_dir"], fname), "w", encoding="utf8") as f:
-            f.write(html)
+    def _total_pages(self, month) -> int:
+        return math.ceil(month.count / self.config["per_page"])
+
+    def _render_month(self, month):
+        """Render all pages of a month."""
+        # Get the days + message counts for the month.
+        dayline = OrderedDict()
+        for d in self.db.get_dayline(month.date.year, month.date.month, self.config["per_page"]):
+            dayline[d.slug] = d
+
+        # Stream the messages of the month page by page, indexing
+        # them for search along the way (by their page in the month).
+        terms = {}
+        total_pages = self._total_pages(month)
+        timeline_html = None if self._nav_include() else self._render_timeline(month)
+        for page, messages in enumerate(self.db.get_pages(month.date.year, month.date.month,
+                                                          self.config["per_page"]), 1):
+            self._render_page(messages, month, dayline, timeline_html,
+                              self.make_filename(month, page), page, total_pages)
+
+            if self.config["publish_search_index"]:
+                with metrics.phase("build.index_messages", len(messages)):
+                    self._index_messages(messages, page - 1, terms)
+
+        if self.config["publish_search_index"]:
+            self._save_month_index(month, 0, terms)
+
+    def _render_parallel(self, months):
+        """
+        Render months across a pool of worker processes. Each worker opens
+        its own read-only DB connection and loads its own templates from the
+        same sources (and bytecode cache).
+        The timeline and the page IDs map are shipped once per worker.
+        """
+        # Render the biggest months first so that the workers finish together.
+        months = sorted(months, key=lambda m: m.count, reverse=True)
+
+        workers = min(self.workers, len(months))
+        with ProcessPoolExecutor(max_workers=workers,
+                                 initializer=_init_worker,
+                                 initargs=(self.config, self.db.dbfile, self.symlink,
+                                           self.sources, self.template_names, self.template_dirs,
+                                           self.timeline, self.page_ids,
+                                           metrics.enabled)) as ex:
+            for phases in ex.map(_render_month, months):
+                metrics.merge(phases)
+
+    def _nav_include(self) -> bool:
+        """Whether the timeline is published once instead of into every page."""
+        return self.config["publish_nav_include"] and "timeline" in self.template.blocks
+
+    def _render_timeline(self, month) -> Markup:
+        """
+        Render the timeline block of the template on its own, with month
+        selected, to splice the same markup into all the pages of a month
+        instead of rendering it for each page. Returns None if the template
+        doesn't have a timeline block.
+        """
+        block = self.template.blocks.get("timeline")
+        if not block:
+            return None
+
+        with metrics.phase("build.render_timeline"):
+            ctx = self.template.new_context({"config": self.config,
+                                             "timeline": self.timeline,
+                                             "month": month})
+            return Markup("".join(block(ctx)))
+
+    def _publish_timeline(self):
+        fpath = os.path.join(self.config["publish_dir"], _TIMELINE_FILE)
+        if not self._nav_include():
+            if self.config["publish_nav_include"]:
+                logging.warning("the template has no timeline block to publish, "
+                                "rendering the timeline into every page")
+            if os.path.exists(fpath):
+                os.remove(fpath)
+            return
+
+        self._write_if_changed(fpath, self._render_timeline(None))
+
+    def _render_page(self, messages, month, dayline, timeline_html, fname, page, total_pages):
+        # Stream the page into the file instead of rendering it into one string.
+        with metrics.phase("build.render_page", len(messages)):
+            out = self.template.stream(config=self.config,
+                                       timeline=self.timeline,
+                                       timeline_html=timeline_html,
+                                       nav_include=self._nav_include(),
+                                       dayline=dayline,
+                                       month=month,
+                                       messages=messages,
+                                       page_ids=self.page_ids,
+                                       pagination={"current": page,
+                                                   "total": total_pages},
+                                       make_filename=self.make_filename,
+                                       nl2br=self._nl2br)
+
+            # Write the output in chunks instead of string by string.
+            out.enable_buffering(_STREAM_CHUNK)
+            with open(os.path.join(self.config["publish_dir"], fname), "w", encoding="utf8",
+                      buffering=_PAGE_BUFFER) as f:
+                out.dump(f)
+
+    def _index_messages(self, messages, page, terms):
+        """
+        Add the messages on the page (index) to the term -> [page, message ID, ...]
+        map of the words in them.
+        """
+        for m in messages:
+            text = m.content or ""
+            if m.media and m.media.title:
+                text += " " + m.media.title
+
+            for t in set(_tokenize(text)):
+                if t in terms:
+                    terms[t].extend((page, m.id))
+                else:
+                    terms[t] = [page, m.id]
+
+    def _month_index_path(self, month) -> str:
+        return os.path.join(self.state_dir, _SEARCH_CACHE_DIR, "{}.json".format(month.slug))
+
+    def _save_month_index(self, month, offset, terms):
+        """
+        Cache the search terms of a month, with its pages numbered from
+        offset (the index of its first page in the site).
+        """
+        os.makedirs(os.path.dirname(self._month_index_path(month)), exist_ok=True)
+        with open(self._month_index_path(month), "w", encoding="utf8") as f:
+            # dumps() encodes in C, where dump() streams in Python.
+            f.write(json.dumps({"offset": offset, "terms": terms},
+                               ensure_ascii=False, separators=(",", ":")))
+
+    def _build_search_index(self, timeline):
+        """
+        Write the static search index: pages.json with the list of all pages,
+        and the terms sharded by their first two characters into one file per
+        prefix, each term mapping to a flat [page index, message ID, ...] list.
+        Big shards are split by longer prefixes (see _split_shards()). The
+        search script only loads the shards of the words in a query.
+        The terms of every month are cached (with the pages already
+        numbered) by the build that rendered it, and the index is only
+        merged again if a month was rendered or the pages have changed.
+        """
+        pages = []
+        for month in timeline:
+            for p in range(1, self._total_pages(month) + 1):
+                pages.append(self.make_filename(month, p))
+
+        sdir = os.path.join(self.config["publish_dir"], _SEARCH_DIR)
+        if not self.rendered:
+            try:
+                with open(os.path.join(sdir, "pages.json"), "r", encoding="utf8") as f:
+                    if json.load(f) == pages:
+                        return
+            except (FileNotFoundError, ValueError):
+                pass
+
+        shards, names = {}, {}
+        offset = 0
+        for month in timeline:
+            try:
+                with open(self._month_index_path(month), "r", encoding="utf8") as f:
+                    cached = json.load(f)
+                terms = cached["terms"]
+            except (FileNotFoundError, ValueError, KeyError):
+                cached = {"offset": offset}
+                terms = {}
+                for page, messages in enumerate(self.db.get_pages(
+                        month.date.year, month.date.month, self.config["per_page"]), offset):
+                    self._index_messages(messages, page, terms)
+                self._save_month_index(month, offset, terms)
+
+            # Renumber the pages if the month has moved since it was cached.
+            if cached["offset"] != offset:
+                delta = offset - cached["offset"]
+                for post in terms.values():
+                    post[::2] = [p + delta for p in post[::2]]
+                self._save_month_index(month, offset, terms)
+
+            for t, post in terms.items():
+                name = names.get(t)
+                if name is None:
+                    name = names[t] = _shard_name(t)
+                shard = shards.get(name)
+                if shard is None:
+                    shard = shards[name] = {}
+                if t in shard:
+                    shard[t].extend(post)
+                else:
+                    shard[t] = post
+
+            offset += self._total_pages(month)
+
+        # Remove the cached terms of months that no longer exist.
+        cdir = os.path.dirname(self._month_index_path(timeline[0]))
+        slugs = set(m.slug + ".json" for m in timeline)
+        for fname in os.listdir(cdir):
+            if fname not in slugs:
+                os.remove(os.path.join(cdir, fname))
+
+        shards = _split_shards(shards)
+        os.makedirs(sdir, exist_ok=True)
+
+        # Only (re)write the files whose contents have changed. pages.json goes
+        # last, as an index is only merged again if it differs.
+        files = {}
+        for name, terms in shards.items():
+            files[name + ".json"] = terms
+        files["pages.json"] = pages
+
+        for fname, data in files.items():
+            self._write_if_changed(os.path.join(sdir, fname),
+                                   json.dumps(data, ensure_ascii=False, separators=(",", ":")))
+
+        for fname in os.listdir(sdir):
+            if fname.endswith(".json") and fname not in files:
+                os.remove(os.path.join(sdir, fname))
+
+        logging.info("published search index with {} shards".format(len(shards)))
+
+    def _compress(self):
+        """
+        Write .gz (and .br, if brotli is installed) siblings of the published
+        text files. Siblings that are as new as their files are kept.
+        """
+        exts = [".gz"] + ([".br"] if brotli else [])
+
+        files = []
+        for root, dirs, fnames in os.walk(self.config["publish_dir"]):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for f in fnames:
+                path = os.path.join(root, f)
+                base, ext = os.path.splitext(path)
+
+                # Remove the siblings of files that no longer exist.
+                if ext in (".gz", ".br") and base.lower().endswith(_COMPRESS_EXTS):
+                    if ext not in exts or not os.path.lexists(base):
+                        os.remove(path)
+                elif ext.lower() in _COMPRESS_EXTS:
+                    files.append(path)
+
+        if self.workers > 1 and len(files) > 1:
+            with ProcessPoolExecutor(max_workers=self.workers) as ex:
+                n = sum(ex.map(_compress_file, files, [exts] * len(files), chunksize=32))
+        else:
+            n = sum(_compress_file(f, exts) for f in files)
+
+        logging.info("compressed {} of {} files".format(n, len(files)))
+
+    def _write_if_changed(self, fpath, data):
+        try:
+            with open(fpath, "r", encoding="utf8") as f:
+                if f.read() == data:
+                    return
+        except FileNotFoundError:
+            pass
+
+        with open(fpath, "w", encoding="utf8") as f:
+            f.write(data)
 
     def _build_rss(self, messages, rss_file, atom_file):
         f = FeedGenerator()
@@ -149,21 +771,11 @@ class Build:
             if m.media and m.media.url:
                 murl = "{}/{}/{}".format(self.config["site_url"],
                                          os.path.basename(self.config["media_dir"]), m.media.url)
-                media_path = "{}/{}".format(self.config["media_dir"], m.media.url)
-                media_mime = "application/octet-stream"
-                media_size = 0
+                media_mime = m.media.mime or "application/octet-stream"
+                media_size = str(m.media.size or 0)
 
-                if "://" in media_path:
+                if "://" in m.media.url:
                     media_mime = "text/html"
-                else:
-                    try:
-                        media_size = str(os.path.getsize(media_path))
-                        try:
-                            media_mime = magic.from_file(media_path, mime=True)
-                        except:
-                            pass
-                    except FileNotFoundError:
-                        pass
 
                 e.enclosure(murl, media_size, media_mime)
             e.content(self._make_abstract(m, media_mime), type="html")
@@ -171,6 +783,46 @@ class Build:
         f.rss_file(os.path.join(self.config["publish_dir"], "index.xml"), pretty=True)
         f.atom_file(os.path.join(self.config["publish_dir"], "index.atom"), pretty=True)
 
+    def backfill_media(self):
+        """
+        Record the size, MIME type and (image) dimensions of media files
+        downloaded before they were recorded at sync time.
+        """
+        media = self.db.get_undescribed_media()
+        logging.info("describing {} media files".format(len(media)))
+
+        missing = 0
+        for n, (id, url) in enumerate(media, 1):
+            fpath = os.path.join(self.config["media_dir"], url)
+            try:
+                size = os.path.getsize(fpath)
+            except FileNotFoundError:
+                missing += 1
+                continue
+
+            mime, width, height = "application/octet-stream", None, None
+            with metrics.phase("build.magic"):
+                try:
+                    mime = magic.from_file(fpath, mime=True)
+                except:
+                    pass
+
+            if mime.startswith("image/"):
+                with metrics.phase("build.image_size"):
+                    try:
+                        with Image.open(fpath) as im:
+                            width, height = im.size
+                    except Exception:
+                        pass
+
+            self.db.set_media_file_info(id, size, mime, width, height)
+            if n % 1000 == 0:
+                self.db.commit()
+
+        self.db.commit()
+        if missing:
+            logging.info("{} media files not found".format(missing))
+
     def _make_abstract(self, m, media_mime):
         if self.rss_template:
             return self.rss_template.render(config=self.config,
@@ -188,38 +840,256 @@ class Build:
         # Jinja's automatic hyperlinking of URLs.
         return _NL2BR.sub("\n\n", s).replace("\n", "\n<br />")
 
-    def _create_publish_dir(self):
-        pubdir = self.config["publish_dir"]
+    def _make_manifest(self, timeline) -> dict:
+        """
+        Make the build manifest with a hash of everything that goes into
+        every page (version, config, templates, and the timeline if the pages
+        show it) and the fingerprints of the individual months. The layout of
+        the pages is added by _map_pages().
+        """
+        h = hashlib.sha1()
+        h.update(__version__.encode("utf8"))
+        h.update(json.dumps(self.config, sort_keys=True, default=str).encode("utf8"))
+        for k in sorted(self.sources):
+            h.update(k.encode("utf8"))
+            h.update(self.sources[k].encode("utf8"))
+        if self._pages_show_timeline():
+            for m in timeline:
+                h.update("{}:{}".format(m.slug, m.count).encode("utf8"))
 
-        # Clear the output directory.
-        if os.path.exists(pubdir):
-            shutil.rmtree(pubdir)
+        fingerprints = self.db.get_month_fingerprints()
+        return {
+            "format": _MANIFEST_FORMAT,
+            "site": h.hexdigest(),
+            "months": {m.slug: fingerprints.get(m.slug) for m in timeline},
+            "pages": {}
+        }
 
-        # Re-create the output directory.
-        os.mkdir(pubdir)
+    def _pages_show_timeline(self) -> bool:
+        """
+        Whether the pages show the timeline (with the message counts of all
+        months), ie: whether any template refers to it. With publish_nav_include,
+        only timeline.html does.
+        """
+        if self._nav_include():
+            return False
 
-        # Copy the static directory into the output directory.
-        for f in [self.config["static_dir"]]:
-            target = os.path.join(pubdir, f)
-            if self.symlink:
-                self._relative_symlink(os.path.abspath(f), target)
-            elif os.path.isfile(f):
-                shutil.copyfile(f, target)
-            else:
-                shutil.copytree(f, target)
+        for src in self.sources.values():
+            if "timeline" in meta.find_undeclared_variables(self.env.parse(src)):
+                return True
+        return False
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.state_dir, _MANIFEST), "r") as f:
+                m = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        return m if m.get("format") == _MANIFEST_FORMAT else None
+
+    def _save_manifest(self, manifest):
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(os.path.join(self.state_dir, _MANIFEST), "w") as f:
+            json.dump(manifest, f)
 
-        # If media downloading is enabled, copy/symlink the media directory.
-        mediadir = self.config["media_dir"]
+    def _remove_stale_pages(self, last, timeline):
+        pages = {m.slug: self._total_pages(m) for m in timeline}
+        for slug, layout in last.get("pages", {}).items():
+            month = Month(date=None, slug=slug, label=None, count=None)
+            for p in range(pages.get(slug, 0) + 1, len(layout) + 1):
+                fpath = os.path.join(self.config["publish_dir"], self.make_filename(month, p))
+                if os.path.exists(fpath):
+                    os.remove(fpath)
+
+    def _create_publish_dir(self, clean=True):
+        pubdir = self.config["publish_dir"]
+
+        # Re-create the output directory.
+        if not os.path.exists(pubdir):
+            os.mkdir(pubdir)
+
+        # Static directory and, if media downloading is enabled, the media
+        # directory to publish into the output directory (by their names, so
+        # that absolute paths are published inside it too).
+        staticdir = os.path.normpath(self.config["static_dir"])
+        targets = [(staticdir, os.path.join(pubdir, os.path.basename(staticdir)))]
+        mediadir = os.path.normpath(self.config["media_dir"])
         if os.path.exists(mediadir):
+            targets.append((mediadir, os.path.join(pubdir, os.path.basename(mediadir))))
+        sources = [src for src, _ in targets]
+
+        # Clear the output directory. Previously published static and media
+        # files are left in place to be synced below instead of being
+        # copied all over again.
+        if clean:
+            keep = set(os.path.relpath(t, pubdir).split(os.sep)[0] for _, t in targets)
+            for f in os.listdir(pubdir):
+                if f not in keep:
+                    self._remove_published(os.path.join(pubdir, f), sources)
+
+        published, removed = 0, 0
+        for src, target in targets:
             if self.symlink:
-                self._relative_symlink(os.path.abspath(mediadir), os.path.join(
-                    pubdir, os.path.basename(mediadir)))
+                if os.path.lexists(target) and not os.path.islink(target):
+                    self._remove_published(target, sources)
+                if not os.path.lexists(target):
+                    self._relative_symlink(os.path.abspath(src), target)
+                continue
+
+            if os.path.islink(target):
+                os.remove(target)
+            if os.path.isfile(src):
+                published += self._publish_file(src, target)
             else:
-                shutil.copytree(mediadir, os.path.join(
-                    pubdir, os.path.basename(mediadir)))
+                p, r = self._sync_dir(src, target)
+                published += p
+                removed += r
+
+        if published or removed:
+            logging.info("published {} new or changed static and media files, removed {}".format(
+                published, removed))
+
+    def _remove_published(self, path, sources):
+        """
+        Remove a file or directory from publish_dir. Refuses to remove
+        anything outside of it, or that is (or contains) one of the source
+        directories being published.
+        """
+        pubdir = os.path.realpath(self.config["publish_dir"])
+        # Resolve the parents but not the path, as a symlink is removed itself.
+        real = os.path.join(os.path.realpath(os.path.dirname(path)), os.path.basename(path))
+        if real == pubdir or os.path.commonpath([pubdir, real]) != pubdir:
+            raise ValueError("refusing to remove '{}' outside of publish_dir".format(path))
+
+        if not os.path.islink(path):
+            for src in sources:
+                if os.path.commonpath([real, os.path.realpath(src)]) == real:
+                    raise ValueError("refusing to remove '{}' that contains the published "
+                                     "directory '{}'".format(path, src))
+        _remove(path)
+
+    def _sync_dir(self, src, dst):
+        """
+        Sync the files in the src directory to dst, publishing only new or
+        changed files and removing the ones that no longer exist in src.
+        Returns the number of files published and removed.
+        """
+        published, removed = 0, 0
+        for root, dirs, files in os.walk(src, followlinks=True):
+            target = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+            if os.path.lexists(target) and not os.path.isdir(target):
+                _remove(target)
+            os.makedirs(target, exist_ok=True)
+
+            for f in files:
+                published += self._publish_file(os.path.join(root, f), os.path.join(target, f))
+
+            # Remove orphans that are no longer in the source directory, except
+            # for the compressed siblings of its files (see _compress()).
+            names = set(dirs) | set(files)
+            for f in os.listdir(target):
+                base, ext = os.path.splitext(f)
+                if f not in names and not (self.config["publish_compressed"] and
+                                           ext in (".gz", ".br") and base in files):
+                    _remove(os.path.join(target, f))
+                    removed += 1
+
+        return published, removed
+
+    def _publish_file(self, src, dst):
+        """
+        Copy or link src to dst unless dst already has the same size and
+        modification time. Returns 1 if the file was published, else 0.
+        """
+        st = os.stat(src)
+        try:
+            dt = os.stat(dst, follow_symlinks=False)
+            if (stat.S_ISREG(dt.st_mode) and dt.st_size == st.st_size and
+                    int(dt.st_mtime) == int(st.st_mtime)):
+                return 0
+            _remove(dst)
+        except FileNotFoundError:
+            pass
+
+        # Links fall back to copying, eg: when the publish directory
+        # is on a different filesystem.
+        mode = self.config["publish_link"]
+        if mode == "hardlink":
+            try:
+                os.link(src, dst)
+                return 1
+            except OSError:
+                pass
+        elif mode == "reflink" and _reflink(src, dst):
+            shutil.copystat(src, dst)
+            return 1
+
+        shutil.copy2(src, dst)
+        return 1
 
     def _relative_symlink(self, src, dst):
         dir_path = os.path.dirname(dst)
         src = os.path.relpath(src, dir_path)
         dst = os.path.join(dir_path, os.path.basename(src))
         return os.symlink(src, dst)
+
+
+# Build instance of a worker process in a parallel build.
+_worker = None
+
+
+def _init_worker(config, dbfile, symlink, sources, template_names, template_dirs,
+                 timeline, page_ids, profile):
+    global _worker
+
+    # Only report what this worker records (a forked worker inherits the parent's metrics).
+    metrics.take()
+    if profile:
+        metrics.enable()
+
+    _worker = Build(config, DB(dbfile, config["timezone"], readonly=True), symlink)
+    _worker.load_sources(sources, template_names, template_dirs)
+    _worker.timeline = timeline
+    _worker.page_ids = page_ids
+
+
+def _render_month(month):
+    """Render a month and return the metrics recorded while rendering it."""
+    _worker._render_month(month)
+    return metrics.take()
+
+
+def _compress_file(path, exts):
+    """
+    Write the compressed siblings of a file with the file's mtime. Returns
+    1 if any sibling was (re)written, else 0.
+    """
+    st = os.stat(path)
+
+    data, n = None, 0
+    for ext in exts:
+        out = path + ext
+        try:
+            if os.stat(out).st_mtime_ns == st.st_mtime_ns:
+                continue
+        except FileNotFoundError:
+            pass
+
+        if data is None:
+            with open(path, "rb") as f:
+                data = f.read()
+
+        if ext == ".gz":
+            b = gzip.compress(data, compresslevel=9, mtime=0)
+        else:
+            b = brotli.compress(data, mode=brotli.MODE_TEXT)
+
+        # Replace the sibling atomically as it may be being served.
+        tmp = out + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(b)
+        os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, out)
+        n = 1
+
+    return n
@@ -1,18 +1,118 @@
+import calendar
 import json
-import math
+import logging
 import os
 import sqlite3
+from bisect import bisect_right
 from collections import namedtuple
-from datetime import datetime
+from collections.abc import Sequence
+from datetime import datetime, timedelta
 import pytz
 from typing import Iterator
 
+from .metrics import metrics
+
+# Full-text search index of message content, sender names and media
+# titles, kept in sync with the tables by triggers. The rowid is the message ID.
+# Media IDs are the IDs of the messages they belong to.
+fts_schema = """
+CREATE VIRTUAL TABLE messages_fts USING fts5(content, sender, media,
+    tokenize='unicode61 remove_diacritics 2');
+##
+CREATE INDEX idx_messages_user ON messages(user_id);
+##
+CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT OR REPLACE INTO messages_fts (rowid, content, sender, media) VALUES (
+        new.id, new.content,
+        (SELECT COALESCE(username, '') || ' ' || COALESCE(first_name, '') || ' ' ||
+            COALESCE(last_name, '') FROM users WHERE id = new.user_id),
+        (SELECT title FROM media WHERE id = new.media_id));
+END;
+##
+CREATE TRIGGER messages_fts_update AFTER UPDATE ON messages BEGIN
+    INSERT OR REPLACE INTO messages_fts (rowid, content, sender, media) VALUES (
+        new.id, new.content,
+        (SELECT COALESCE(username, '') || ' ' || COALESCE(first_name, '') || ' ' ||
+            COALESCE(last_name, '') FROM users WHERE id = new.user_id),
+        (SELECT title FROM media WHERE id = new.media_id));
+END;
+##
+CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+    DELETE FROM messages_fts WHERE rowid = old.id;
+END;
+##
+CREATE TRIGGER users_fts_update AFTER UPDATE ON users
+WHEN old.username IS NOT new.username OR old.first_name IS NOT new.first_name
+    OR old.last_name IS NOT new.last_name BEGIN
+    UPDATE messages_fts SET sender = COALESCE(new.username, '') || ' ' ||
+        COALESCE(new.first_name, '') || ' ' || COALESCE(new.last_name, '')
+    WHERE rowid IN (SELECT id FROM messages WHERE user_id = new.id);
+END;
+##
+CREATE TRIGGER media_fts_insert AFTER INSERT ON media BEGIN
+    UPDATE messages_fts SET media = new.title WHERE rowid = new.id;
+END;
+##
+CREATE TRIGGER media_fts_update AFTER UPDATE OF title ON media BEGIN
+    UPDATE messages_fts SET media = new.title WHERE rowid = new.id;
+END;
+"""
+
+# Number of changes to the messages (and the users and media they refer to)
+# in every 15 minute bucket of time (ts / 900), kept by triggers, so that a
+# month's fingerprint is a sum over its buckets instead of a scan of its rows.
+# Every timezone offset in use is a multiple of 15 minutes, so buckets don't
+# straddle months (if one does, a change re-renders both months).
+changes_schema = """
+CREATE table changes (
+    bucket INTEGER NOT NULL PRIMARY KEY,
+    n INTEGER NOT NULL
+);
+##
+CREATE TRIGGER messages_changes_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO changes (bucket, n) VALUES (new.ts / 900, 1)
+        ON CONFLICT (bucket) DO UPDATE SET n = n + 1;
+END;
+##
+CREATE TRIGGER messages_changes_update AFTER UPDATE ON messages BEGIN
+    INSERT INTO changes (bucket, n) VALUES (old.ts / 900, 1)
+        ON CONFLICT (bucket) DO UPDATE SET n = n + 1;
+    INSERT INTO changes (bucket, n) VALUES (new.ts / 900, 1)
+        ON CONFLICT (bucket) DO UPDATE SET n = n + 1;
+END;
+##
+CREATE TRIGGER messages_changes_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO changes (bucket, n) VALUES (old.ts / 900, 1)
+        ON CONFLICT (bucket) DO UPDATE SET n = n + 1;
+END;
+##
+CREATE TRIGGER users_changes_update AFTER UPDATE ON users BEGIN
+    INSERT INTO changes (bucket, n)
+        SELECT DISTINCT ts / 900, 1 FROM messages WHERE user_id = new.id
+        ON CONFLICT (bucket) DO UPDATE SET n = n + 1;
+END;
+##
+CREATE TRIGGER media_changes_insert AFTER INSERT ON media BEGIN
+    INSERT INTO changes (bucket, n)
+        SELECT ts / 900, 1 FROM messages WHERE id = new.id
+        ON CONFLICT (bucket) DO UPDATE SET n = n + 1;
+END;
+##
+CREATE TRIGGER media_changes_update AFTER UPDATE ON media BEGIN
+    INSERT INTO changes (bucket, n)
+        SELECT ts / 900, 1 FROM messages WHERE id = new.id
+        ON CONFLICT (bucket) DO UPDATE SET n = n + 1;
+END;
+"""
+
 schema = """
 CREATE table messages (
     id INTEGER NOT NULL PRIMARY KEY,
     type TEXT NOT NULL,
     date TIMESTAMP NOT NULL,
+    ts INTEGER,
     edit_date TIMESTAMP,
+    edit_ts INTEGER,
     content TEXT,
     reply_to INTEGER,
     user_id INTEGER,
@@ -21,6 +121,10 @@ CREATE table messages (
     FOREIGN KEY(media_id) REFERENCES media(id)
 );
 ##
+CREATE INDEX idx_messages_ts ON messages(ts);
+##
+CREATE INDEX idx_messages_reply_to ON messages(reply_to) WHERE reply_to IS NOT NULL;
+##
 CREATE table users (
     id INTEGER NOT NULL PRIMARY KEY,
     username TEXT,
@@ -36,88 +140,431 @@ CREATE table media (
     url TEXT,
     title TEXT,
     description TEXT,
-    thumb TEXT
+    thumb TEXT,
+    status TEXT,
+    size INTEGER,
+    mime TEXT,
+    width INTEGER,
+    height INTEGER
 );
-"""
+##
+CREATE table avatars (
+    user_id INTEGER NOT NULL PRIMARY KEY,
+    photo_id INTEGER NOT NULL,
+    file TEXT
+);
+##
+CREATE table groups (
+    name TEXT NOT NULL PRIMARY KEY,
+    type TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    access_hash INTEGER
+);
+##
+CREATE table segments (
+    id INTEGER NOT NULL PRIMARY KEY,
+    last_id INTEGER NOT NULL,
+    max_id INTEGER NOT NULL
+);
+##
+""" + fts_schema + """
+##
+""" + changes_schema
+
+# Migrations that upgrade existing DBs to the current schema in place.
+# The schema version of a DB (PRAGMA user_version) is the number of
+# migrations applied to it. New DBs are created from the schema above,
+# which always has the latest layout, and skip the migrations.
+migrations = [
+    # 1: Unix timestamp of the message date for indexed range queries.
+    """
+    ALTER TABLE messages ADD COLUMN ts INTEGER;
+    ##
+    UPDATE messages SET ts = CAST(strftime('%s', date) AS INTEGER);
+    ##
+    CREATE INDEX idx_messages_ts ON messages(ts);
+    """,
+
+    # 2: Download status of media (NULL when done, pending or failed).
+    """
+    ALTER TABLE media ADD COLUMN status TEXT;
+    """,
+
+    # 3: Profile photo IDs of downloaded avatars to detect changes.
+    """
+    CREATE table avatars (
+        user_id INTEGER NOT NULL PRIMARY KEY,
+        photo_id INTEGER NOT NULL,
+        file TEXT
+    );
+    """,
+
+    # 4: Size, MIME type and dimensions of downloaded media files.
+    """
+    ALTER TABLE media ADD COLUMN size INTEGER;
+    ##
+    ALTER TABLE media ADD COLUMN mime TEXT;
+    ##
+    ALTER TABLE media ADD COLUMN width INTEGER;
+    ##
+    ALTER TABLE media ADD COLUMN height INTEGER;
+    """,
+
+    # 5: Full-text search index.
+    fts_schema + """
+    ##
+    INSERT INTO messages_fts (rowid, content, sender, media)
+    SELECT messages.id, messages.content,
+        COALESCE(users.username, '') || ' ' || COALESCE(users.first_name, '') || ' ' ||
+            COALESCE(users.last_name, ''),
+        media.title
+    FROM messages
+    LEFT JOIN users ON (users.id = messages.user_id)
+    LEFT JOIN media ON (media.id = messages.media_id);
+    """,
+
+    # 6: Resolved groups (by the group in the config) to skip resolving them on every sync.
+    """
+    CREATE table groups (
+        name TEXT NOT NULL PRIMARY KEY,
+        type TEXT NOT NULL,
+        id INTEGER NOT NULL,
+        access_hash INTEGER
+    );
+    """,
+
+    # 7: Progress of the segments of a concurrent backfill.
+    """
+    CREATE table segments (
+        id INTEGER NOT NULL PRIMARY KEY,
+        last_id INTEGER NOT NULL,
+        max_id INTEGER NOT NULL
+    );
+    """,
+
+    # 8: Unix timestamp of the edit date, so that dates are read without parsing.
+    """
+    ALTER TABLE messages ADD COLUMN edit_ts INTEGER;
+    ##
+    UPDATE messages SET edit_ts = CAST(strftime('%s', edit_date) AS INTEGER)
+        WHERE edit_date IS NOT NULL;
+    """,
+
+    # 9: Replies by the messages they reply to, to find the pages that link to a message.
+    """
+    CREATE INDEX idx_messages_reply_to ON messages(reply_to) WHERE reply_to IS NOT NULL;
+    """,
+
+    # 10: Change counters of the messages by time, for cheap month fingerprints.
+    changes_schema + """
+    ##
+    INSERT INTO changes (bucket, n) SELECT ts / 900, 1 FROM messages GROUP BY ts / 900;
+    """,
+]
 
 User = namedtuple(
     "User", ["id", "username", "first_name", "last_name", "tags", "avatar"])
 
+# day is the yyyy-mm-dd (slug of the Day) of the date in the DB's timezone.
 Message = namedtuple(
-    "Message", ["id", "type", "date", "edit_date", "content", "reply_to", "user", "media"])
+    "Message", ["id", "type", "date", "edit_date", "content", "reply_to", "user", "media", "day"],
+    defaults=[None])
 
+# status is None for media that is complete, or "pending" / "failed"
+# for media whose file hasn't been downloaded (yet). size (bytes), mime,
+# width and height describe downloaded files and are None otherwise.
 Media = namedtuple(
-    "Media", ["id", "type", "url", "title", "description", "thumb"])
+    "Media", ["id", "type", "url", "title", "description", "thumb", "status",
+              "size", "mime", "width", "height"],
+    defaults=[None, None, None, None, None])
 
 Month = namedtuple("Month", ["date", "slug", "label", "count"])
 
 Day = namedtuple("Day", ["date", "slug", "label", "count", "page"])
 
+# A full-text search hit with a highlighted snippet of the matching
+# text and the month and page number on which the message is published.
+SearchResult = namedtuple("SearchResult", ["message", "snippet", "month", "page"])
+
+# Upsert a user. The row is only updated if any of the fields have changed.
+_insert_user_query = """
+    INSERT INTO users (id, username, first_name, last_name, tags, avatar)
+    VALUES(?, ?, ?, ?, ?, ?) ON CONFLICT (id)
+    DO UPDATE SET username=excluded.username, first_name=excluded.first_name,
+        last_name=excluded.last_name, tags=excluded.tags, avatar=excluded.avatar
+    WHERE (users.username, users.first_name, users.last_name, users.tags, users.avatar)
+        IS NOT (excluded.username, excluded.first_name, excluded.last_name,
+            excluded.tags, excluded.avatar)
+"""
+
+_insert_media_query = """
+    INSERT OR REPLACE INTO media
+    (id, type, url, title, description, thumb, status, size, mime, width, height)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+_insert_message_query = """
+    INSERT OR REPLACE INTO messages
+    (id, type, date, ts, edit_date, edit_ts, content, reply_to, user_id, media_id)
+    VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
 
-def _page(n, multiple):
-    return math.ceil(n / multiple)
+# Messages joined with their media in the column order expected by
+# DB._make_message(). Media that hasn't been downloaded is left out. Users
+# aren't joined, but looked up in the users loaded once by the DB.
+_messages_query = """
+    SELECT messages.id, messages.type, messages.ts, messages.edit_ts,
+    messages.content, messages.reply_to, messages.user_id,
+    media.id, media.type, media.url, media.title, media.description, media.thumb,
+    media.size, media.mime, media.width, media.height
+    FROM messages
+    LEFT JOIN media ON (media.id = messages.media_id AND media.status IS NULL)
+"""
+
+
+class _PollOptions(Sequence):
+    """
+    The options of a poll (the description of its Media), decoded from
+    their JSON only when they're first accessed, eg: by a template.
+    """
+    __slots__ = ("_json", "_options")
+
+    def __init__(self, s):
+        self._json = s
+        self._options = None
+
+    def _decode(self) -> list:
+        if self._options is None:
+            self._options = json.loads(self._json)
+        return self._options
+
+    def __getitem__(self, i):
+        return self._decode()[i]
+
+    def __len__(self):
+        return len(self._decode())
+
+    def __iter__(self):
+        return iter(self._decode())
+
+    def __repr__(self):
+        return repr(self._decode())
+
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+class _Zone:
+    """
+    Converts Unix timestamps to dates and days in a (pytz) timezone with
+    a table of the timezone's UTC offset transitions that is built once,
+    instead of a timezone lookup per date. Consecutive timestamps, eg: the
+    messages of a page, mostly fall between the same two transitions and
+    reuse the last offset without a lookup.
+    """
+
+    def __init__(self, tz):
+        self.tz = tz
+
+        # UTC timestamps of the transitions and the (offset seconds, tzinfo)
+        # from each, as used by pytz's own fromutc().
+        self._times, self._offsets = [], []
+        for n, t in enumerate(getattr(tz, "_utc_transition_times", None) or []):
+            inf = tz._transition_info[n]
+            self._times.append(calendar.timegm(t.timetuple()) if n > 0 else float("-inf"))
+            self._offsets.append((int(inf[0].total_seconds()), tz._tzinfos[inf]))
+
+        if not self._times:
+            self._times = [float("-inf")]
+            self._offsets = [(int(tz.utcoffset(_EPOCH).total_seconds()), tz)]
+
+        # The offset between the last two transitions that were looked up,
+        # and the local date of the epoch with it that dates are made from.
+        self._lo, self._hi = 0, 0
+        self._offset, self._base = 0, None
+
+        # Map of local day numbers (days since the epoch) -> yyyy-mm-dd.
+        self._days = {}
+
+    def _seek(self, ts):
+        i = bisect_right(self._times, ts) - 1
+        self._lo = self._times[i]
+        self._hi = self._times[i + 1] if i + 1 < len(self._times) else float("inf")
+        self._offset, tzinfo = self._offsets[i]
+        self._base = (_EPOCH + timedelta(seconds=self._offset)).replace(tzinfo=tzinfo)
+
+    def offset(self, ts) -> int:
+        """Get the UTC offset (seconds) of the timezone at a timestamp."""
+        if not self._lo <= ts < self._hi:
+            self._seek(ts)
+        return self._offset
+
+    def date(self, ts) -> datetime:
+        """Get the (aware) local date of a timestamp."""
+        if not self._lo <= ts < self._hi:
+            self._seek(ts)
+        return self._base + timedelta(0, ts)
+
+    def day(self, ts) -> str:
+        """Get the local yyyy-mm-dd day of a timestamp."""
+        return self.day_slug((ts + self.offset(ts)) // 86400)
+
+    def day_slug(self, n) -> str:
+        """Get the yyyy-mm-dd of a local day number."""
+        day = self._days.get(n)
+        if day is None:
+            day = self._days[n] = (_EPOCH + timedelta(days=n)).strftime("%Y-%m-%d")
+        return day
+
+    def localize(self, d) -> datetime:
+        """Get the aware date of a naive local date."""
+        return self.tz.localize(d)
+
+    def month_range(self, year, month) -> [int, int]:
+        """Get the [start, end) Unix timestamps of a local yyyy-mm month."""
+        start = self.localize(datetime(year, month, 1))
+        if month == 12:
+            year, month = year + 1, 0
+        end = self.localize(datetime(year, month + 1, 1))
+        return calendar.timegm(start.utctimetuple()), calendar.timegm(end.utctimetuple())
 
 
 class DB:
     conn = None
     tz = None
 
-    def __init__(self, dbfile, tz=None):
+    def __init__(self, dbfile, tz=None, readonly=False):
         # Initialize the SQLite DB. If it's new, create the table schema.
-        is_new = not os.path.isfile(dbfile)
+        is_new = not os.path.isfile(dbfile) and not readonly
+        self.dbfile = dbfile
+
+        # Rows of the users last written, to skip rewriting unchanged users.
+        self._users = {}
+
+        # Journal mode and synchronous setting before set_bulk_mode(), to
+        # restore them after.
+        self._journal_mode = None
 
-        self.conn = sqlite3.Connection(
-            dbfile, detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES)
+        # Map of user ID -> User of all users, shared by the messages that are
+        # read, and the data_version of the DB they were loaded at.
+        self._user_cache = None
+        self._user_cache_version = None
 
-        # Add the custom PAGE() function to get the page number of a row
-        # by its row number and a limit multiple.
-        self.conn.create_function("PAGE", 2, _page)
+        if readonly:
+            dbfile = "file:{}?mode=ro".format(os.path.abspath(dbfile))
+
+        # The connection can be handed to another thread, eg: the DB writer
+        # thread of the sync, which then makes all the writes.
+        self.conn = sqlite3.Connection(dbfile, uri=readonly, check_same_thread=False)
 
         if tz:
             self.tz = pytz.timezone(tz)
 
+        # Dates are stored as Unix timestamps and read as dates in the timezone
+        # (or UTC). Months and days are grouped in the timezone.
+        self._zone = _Zone(self.tz or pytz.utc)
+
         if is_new:
             for s in schema.split("##"):
                 self.conn.cursor().execute(s)
                 self.conn.commit()
+            self._set_version(len(migrations))
+        elif not readonly:
+            self._migrate()
+
+    def _migrate(self):
+        """Apply the migrations that an existing DB is missing."""
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA user_version")
+        version, = cur.fetchone()
+
+        for n, m in enumerate(migrations[version:], version + 1):
+            logging.info("upgrading DB schema to version {}".format(n))
+            for s in m.split("##"):
+                cur.execute(s)
+            self._set_version(n)
+            self.conn.commit()
+
+    def _set_version(self, version):
+        self.conn.cursor().execute("PRAGMA user_version = {}".format(int(version)))
+        self.conn.commit()
 
     def _parse_date(self, d) -> str:
         return datetime.strptime(d, "%Y-%m-%dT%H:%M:%S%z")
 
     def get_last_message_id(self) -> [int, datetime]:
         cur = self.conn.cursor()
-        cur.execute("""
-            SELECT id, strftime('%Y-%m-%d 00:00:00', date) as "[timestamp]" FROM messages
-            ORDER BY id DESC LIMIT 1
-        """)
+        cur.execute("SELECT id, ts FROM messages ORDER BY id DESC LIMIT 1")
         res = cur.fetchone()
         if not res:
             return 0, None
 
-        id, date = res
-        return id, date
+        id, ts = res
+        return id, self._zone.date(ts)
 
-    def get_timeline(self) -> Iterator[Month]:
+    def _month_range(self, year, month) -> [int, int]:
+        return self._zone.month_range(year, month)
+
+    def _load_users(self):
         """
-        Get the list of all unique yyyy-mm month groups and
-        the corresponding message counts per period in chronological order.
+        Load all users into the user cache unless they're already loaded and
+        no other connection (eg: a sync) has changed the DB since.
         """
         cur = self.conn.cursor()
-        cur.execute("""
-            SELECT strftime('%Y-%m-%d 00:00:00', date) as "[timestamp]",
-            COUNT(*) FROM messages AS count
-            GROUP BY strftime('%Y-%m', date) ORDER BY date
-        """)
-
-        for r in cur.fetchall():
-            date = pytz.utc.localize(r[0])
-            if self.tz:
-                date = date.astimezone(self.tz)
+        cur.execute("PRAGMA data_version")
+        version, = cur.fetchone()
+        if self._user_cache is not None and version == self._user_cache_version:
+            return
+
+        cur.execute("SELECT id, username, first_name, last_name, tags, avatar FROM users")
+        self._user_cache = {r[0]: User(id=r[0],
+                                       username=r[1],
+                                       first_name=r[2],
+                                       last_name=r[3],
+                                       tags=r[4].split() if r[4] else [],
+                                       avatar=r[5]) for r in cur}
+        self._user_cache_version = version
+
+    def _months(self) -> Iterator[tuple]:
+        """
+        Get the (year, month, start, end) of every month in the timezone from
+        the first message to the last one, with the [start, end) timestamps.
+        """
+        cur = self.conn.cursor()
+        cur.execute("SELECT MIN(ts), MAX(ts) FROM messages")
+        first, last = cur.fetchone()
+        if first is None:
+            return
+
+        d, last = self._zone.date(first), self._zone.date(last)
+        year, month = d.year, d.month
+        while (year, month) <= (last.year, last.month):
+            yield (year, month) + tuple(self._month_range(year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+    def _make_month(self, year, month, count) -> Month:
+        date = self._zone.localize(datetime(year, month, 1))
+        return Month(date=date,
+                     slug=date.strftime("%Y-%m"),
+                     label=date.strftime("%b %Y"),
+                     count=count)
 
-            yield Month(date=date,
-                        slug=date.strftime("%Y-%m"),
-                        label=date.strftime("%b %Y"),
-                        count=r[1])
+    def get_timeline(self) -> Iterator[Month]:
+        """
+        Get the list of all unique yyyy-mm month groups (in the timezone) and
+        the corresponding message counts per period in chronological order.
+        """
+        with metrics.phase("db.get_timeline"):
+            months = []
+            cur = self.conn.cursor()
+            for year, month, start, end in self._months():
+                cur.execute("SELECT COUNT(*) FROM messages WHERE ts >= ? AND ts < ?",
+                            (start, end))
+                count, = cur.fetchone()
+                if count:
+                    months.append(self._make_month(year, month, count))
+
+        yield from months
 
     def get_dayline(self, year, month, limit=500) -> Iterator[Day]:
         """
@@ -125,135 +572,362 @@ class DB:
         message counts and the page number of the first occurrence of 
         the date in the pool of messages for the whole month.
         """
-        cur = self.conn.cursor()
-        cur.execute("""
-            SELECT strftime("%Y-%m-%d 00:00:00", date) AS "[timestamp]",
-            COUNT(*), PAGE(rank, ?) FROM (
-                SELECT ROW_NUMBER() OVER() as rank, date FROM messages
-                WHERE strftime('%Y%m', date) = ? ORDER BY id
-            )
-            GROUP BY "[timestamp]";
-        """, (limit, "{}{:02d}".format(year, month)))
-
-        for r in cur.fetchall():
-            date = pytz.utc.localize(r[0])
-            if self.tz:
-                date = date.astimezone(self.tz)
-
+        # Walk the timestamps in the order of pagination, which only
+        # reads the (covering) ts index, and count the days on the fly.
+        with metrics.phase("db.get_dayline"):
+            cur = self.conn.cursor()
+            cur.execute("""
+                SELECT ts FROM messages WHERE ts >= ? AND ts < ? ORDER BY id
+            """, self._month_range(year, month))
+
+            # Local day numbers (days since the epoch) -> [count, page].
+            days = {}
+            offset = self._zone.offset
+            for n, (ts,) in enumerate(cur):
+                day = (ts + offset(ts)) // 86400
+                if day not in days:
+                    days[day] = [0, n // limit + 1]
+                days[day][0] += 1
+
+        for day, (count, page) in sorted(days.items()):
+            date = self._zone.localize(_EPOCH + timedelta(days=day))
             yield Day(date=date,
-                      slug=date.strftime("%Y-%m-%d"),
+                      slug=self._zone.day_slug(day),
                       label=date.strftime("%d %b %Y"),
-                      count=r[1],
-                      page=r[2])
+                      count=count,
+                      page=page)
 
     def get_messages(self, year, month, last_id=0, limit=500) -> Iterator[Message]:
-        date = "{}{:02d}".format(year, month)
+        start, end = self._month_range(year, month)
+
+        with metrics.phase("db.get_messages") as p:
+            self._load_users()
+            cur = self.conn.cursor()
+            cur.execute(_messages_query + """
+                WHERE messages.ts >= ? AND messages.ts < ?
+                AND messages.id > ? ORDER by messages.id LIMIT ?
+                """, (start, end, last_id, limit))
 
+            messages = [self._make_message(r) for r in cur.fetchall()]
+            p.items = len(messages)
+
+        yield from messages
+
+    def get_pages(self, year, month, limit=500) -> Iterator[list]:
+        """
+        Stream all messages of a month in pages of `limit` messages
+        from a single ordered cursor. Only one page is held in memory at a time.
+        """
+        self._load_users()
+        cur = self.conn.cursor()
+        cur.execute(_messages_query + """
+            WHERE messages.ts >= ? AND messages.ts < ?
+            ORDER by messages.id
+            """, self._month_range(year, month))
+
+        while True:
+            with metrics.phase("db.get_pages") as p:
+                rows = cur.fetchmany(limit)
+                messages = [self._make_message(r) for r in rows]
+                p.items = len(messages)
+
+            if not messages:
+                break
+            yield messages
+
+    def get_message_ids(self, year, month) -> Iterator[int]:
+        """Get the IDs of all messages in a month in the order they're paginated."""
         cur = self.conn.cursor()
         cur.execute("""
-            SELECT messages.id, messages.type, messages.date, messages.edit_date,
-            messages.content, messages.reply_to, messages.user_id,
-            users.username, users.first_name, users.last_name, users.tags, users.avatar,
-            media.id, media.type, media.url, media.title, media.description, media.thumb
-            FROM messages
-            LEFT JOIN users ON (users.id = messages.user_id)
-            LEFT JOIN media ON (media.id = messages.media_id)
-            WHERE strftime('%Y%m', date) = ?
-            AND messages.id > ? ORDER by messages.id LIMIT ?
-            """, (date, last_id, limit))
-
-        for r in cur.fetchall():
-            yield self._make_message(r)
+            SELECT id FROM messages WHERE ts >= ? AND ts < ? ORDER BY id
+            """, self._month_range(year, month))
 
-    def get_message_count(self, year, month) -> int:
-        date = "{}{:02d}".format(year, month)
+        for r in cur:
+            yield r[0]
+
+    def get_month_fingerprints(self) -> dict:
+        """
+        Get a fingerprint of every yyyy-mm month group that changes whenever
+        the month's messages, or the users or media they refer to, change.
+        The fingerprint is [count, number of changes to the month's time
+        buckets], which only reads the index and the changes table.
+        """
+        cur = self.conn.cursor()
+        out = {}
+        for year, month, start, end in self._months():
+            cur.execute("""
+                SELECT COUNT(*), (SELECT SUM(n) FROM changes WHERE bucket >= ? AND bucket <= ?)
+                FROM messages WHERE ts >= ? AND ts < ?
+            """, (start // 900, (end - 1) // 900, start, end))
+
+            r = cur.fetchone()
+            if r[0]:
+                out["{:04d}-{:02d}".format(year, month)] = list(r)
 
+        return out
+
+    def get_replying_months(self, ranges) -> set:
+        """
+        Get the yyyy-mm slugs of the months with replies to any of the
+        messages in the given [first, last] message ID ranges.
+        """
+        cur = self.conn.cursor()
+        out = set()
+        for first, last in ranges:
+            cur.execute("""
+                SELECT DISTINCT ts FROM messages
+                WHERE reply_to >= ? AND reply_to <= ? AND reply_to IS NOT NULL
+                """, (first, last))
+            out.update(self._zone.date(ts).strftime("%Y-%m") for ts, in cur)
+
+        return out
+
+    def search(self, query, per_page=500, limit=20) -> Iterator[SearchResult]:
+        """
+        Search messages by their content, sender names and media titles with
+        an FTS5 query and get the best matches first.
+        """
         cur = self.conn.cursor()
         cur.execute("""
-            SELECT COUNT(*) FROM messages WHERE strftime('%Y%m', date) = ?
-            """, (date,))
+            SELECT rowid, snippet(messages_fts, -1, '[', ']', '...', 12)
+            FROM messages_fts WHERE messages_fts MATCH ? ORDER BY rank LIMIT ?
+        """, (query, limit))
+
+        self._load_users()
+        for id, snippet in cur.fetchall():
+            cur.execute(_messages_query + "WHERE messages.id = ?", (id,))
+            r = cur.fetchone()
+            if not r:
+                continue
+
+            # The page of the message is its position within its month.
+            m = self._make_message(r)
+            start, end = self._month_range(m.date.year, m.date.month)
+            cur.execute("""
+                SELECT COUNT(*) FROM messages WHERE ts >= ? AND ts < ? AND id < ?
+            """, (start, end, id))
+            n, = cur.fetchone()
+
+            yield SearchResult(message=m,
+                               snippet=snippet,
+                               month=self._make_month(m.date.year, m.date.month, None),
+                               page=n // per_page + 1)
+
+    def get_message_count(self, year, month) -> int:
+        cur = self.conn.cursor()
+        cur.execute("""
+            SELECT COUNT(*) FROM messages WHERE ts >= ? AND ts < ?
+            """, self._month_range(year, month))
 
         total, = cur.fetchone()
         return total
 
     def insert_user(self, u: User):
         """Insert a user and if they exist, update the fields."""
-        cur = self.conn.cursor()
-        cur.execute("""INSERT INTO users (id, username, first_name, last_name, tags, avatar)
-            VALUES(?, ?, ?, ?, ?, ?) ON CONFLICT (id)
-            DO UPDATE SET username=excluded.username, first_name=excluded.first_name,
-                last_name=excluded.last_name, tags=excluded.tags, avatar=excluded.avatar
-            """, (u.id, u.username, u.first_name, u.last_name, " ".join(u.tags), u.avatar))
+        row = self._user_row(u)
+        self.conn.cursor().execute(_insert_user_query, row)
+        self._users[u.id] = row
+        self._user_cache = None
 
     def insert_media(self, m: Media):
+        self.conn.cursor().execute(_insert_media_query, self._media_row(m))
+
+    def set_media_status(self, id, status):
+        self.conn.cursor().execute("UPDATE media SET status = ? WHERE id = ?", (status, id))
+
+    def get_incomplete_media(self) -> list:
+        """Get the IDs of all media that is pending or failed download."""
         cur = self.conn.cursor()
-        cur.execute("""INSERT OR REPLACE INTO media
-            (id, type, url, title, description, thumb)
-            VALUES(?, ?, ?, ?, ?, ?)""",
-                    (m.id,
-                     m.type,
-                     m.url,
-                     m.title,
-                     m.description,
-                     m.thumb)
-                    )
+        cur.execute("SELECT id FROM media WHERE status IS NOT NULL ORDER BY id")
+        return [r[0] for r in cur.fetchall()]
+
+    def get_undescribed_media(self) -> list:
+        """Get the (id, url) of all downloaded media files without a recorded size."""
+        cur = self.conn.cursor()
+        cur.execute("""SELECT id, url FROM media WHERE status IS NULL AND type = 'photo'
+            AND url IS NOT NULL AND size IS NULL ORDER BY id""")
+        return cur.fetchall()
+
+    def set_media_file_info(self, id, size, mime, width, height):
+        self.conn.cursor().execute("""UPDATE media SET size = ?, mime = ?, width = ?, height = ?
+            WHERE id = ?""", (size, mime, width, height, id))
+
+    def get_avatars(self) -> dict:
+        """Get the map of user ID -> (profile photo ID, file) of all downloaded avatars."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT user_id, photo_id, file FROM avatars")
+        return {r[0]: (r[1], r[2]) for r in cur.fetchall()}
+
+    def insert_avatar(self, user_id, photo_id, file):
+        self.conn.cursor().execute("""INSERT OR REPLACE INTO avatars
+            (user_id, photo_id, file) VALUES(?, ?, ?)""", (user_id, photo_id, file))
+
+    def get_group(self, name) -> tuple:
+        """Get the (type, id, access_hash) of a resolved group, or None."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT type, id, access_hash FROM groups WHERE name = ?", (name,))
+        return cur.fetchone()
+
+    def insert_group(self, name, typ, id, access_hash):
+        self.conn.cursor().execute("""INSERT OR REPLACE INTO groups
+            (name, type, id, access_hash) VALUES(?, ?, ?, ?)""", (name, typ, id, access_hash))
+        self.conn.commit()
+
+    def delete_group(self, name):
+        with self.conn:
+            self.conn.cursor().execute("DELETE FROM groups WHERE name = ?", (name,))
+
+    def get_segments(self) -> list:
+        """Get the (id, last_id, max_id) of the unfinished segments of a backfill."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT id, last_id, max_id FROM segments ORDER BY id")
+        return cur.fetchall()
+
+    def insert_segments(self, segments: list):
+        """Insert backfill segments as (last_id, max_id) ID ranges of (last_id, max_id]."""
+        with self.conn:
+            self.conn.cursor().executemany(
+                "INSERT INTO segments (last_id, max_id) VALUES(?, ?)", segments)
+
+    def set_segment(self, id, last_id):
+        with self.conn:
+            self.conn.cursor().execute("UPDATE segments SET last_id = ? WHERE id = ?", (last_id, id))
+
+    def delete_segment(self, id):
+        with self.conn:
+            self.conn.cursor().execute("DELETE FROM segments WHERE id = ?", (id,))
 
     def insert_message(self, m: Message):
+        self.conn.cursor().execute(_insert_message_query, self._message_row(m))
+
+    def insert_messages(self, messages: list):
+        """
+        Insert a batch of messages along with their users and media in a single
+        transaction. The users are deduplicated and only the ones that have
+        changed since they were last written by this DB are upserted.
+        """
+        users = {}
+        for m in messages:
+            row = self._user_row(m.user)
+            if self._users.get(m.user.id) != row:
+                users[m.user.id] = row
+
+        with metrics.phase("db.insert_messages", len(messages)), self.conn:
+            cur = self.conn.cursor()
+            cur.executemany(_insert_user_query, users.values())
+            cur.executemany(_insert_media_query,
+                            [self._media_row(m.media) for m in messages if m.media])
+            cur.executemany(_insert_message_query,
+                            [self._message_row(m) for m in messages])
+
+        self._users.update(users)
+        if users:
+            self._user_cache = None
+
+    def delete_messages(self, ids: list) -> int:
+        """Delete messages and their media by ID. Returns the number of messages deleted."""
+        rows = [(i,) for i in ids]
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.executemany("DELETE FROM media WHERE id = ?", rows)
+            cur.executemany("DELETE FROM messages WHERE id = ?", rows)
+            return cur.rowcount
+
+    def set_bulk_mode(self):
+        """
+        Trade durability on power loss for write throughput on large imports:
+        a write-ahead log that isn't fsync'd on every commit. The DB can't be
+        corrupted by a crash, but the last commits may be lost. The WAL
+        journal mode is stored in the DB file and stays on for every later
+        connection until end_bulk_mode() switches back.
+        """
+        cur = self.conn.cursor()
+        cur.execute("PRAGMA journal_mode")
+        mode, = cur.fetchone()
+        cur.execute("PRAGMA synchronous")
+        self._journal_mode = (mode, cur.fetchone()[0])
+        cur.execute("PRAGMA journal_mode = WAL")
+        cur.execute("PRAGMA synchronous = NORMAL")
+
+    def end_bulk_mode(self):
+        """
+        Switch back to the journal mode (and synchronous setting) the DB had
+        before set_bulk_mode(), checkpointing the write-ahead log into the DB file.
+        """
+        if self._journal_mode is None:
+            return
+
+        mode, sync = self._journal_mode
+        self.conn.commit()
         cur = self.conn.cursor()
-        cur.execute("""INSERT OR REPLACE INTO messages
-            (id, type, date, edit_date, content, reply_to, user_id, media_id)
-            VALUES(?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (m.id,
-                     m.type,
-                     m.date.strftime("%Y-%m-%d %H:%M:%S"),
-                     m.edit_date.strftime(
-                         "%Y-%m-%d %H:%M:%S") if m.edit_date else None,
-                     m.content,
-                     m.reply_to,
-                     m.user.id,
-                     m.media.id if m.media else None)
-                    )
+        cur.execute("PRAGMA journal_mode = {}".format(mode))
+        cur.execute("PRAGMA synchronous = {}".format(int(sync)))
+        self._journal_mode = None
 
     def commit(self):
         """Commit pending writes to the DB."""
         self.conn.commit()
 
+    def _user_row(self, u: User) -> tuple:
+        return (u.id, u.username, u.first_name, u.last_name, " ".join(u.tags), u.avatar)
+
+    def _media_row(self, m: Media) -> tuple:
+        return (m.id, m.type, m.url, m.title, m.description, m.thumb, m.status,
+                m.size, m.mime, m.width, m.height)
+
+    def _message_row(self, m: Message) -> tuple:
+        return (m.id,
+                m.type,
+                m.date.strftime("%Y-%m-%d %H:%M:%S"),
+                int(m.date.timestamp()),
+                m.edit_date.strftime(
+                    "%Y-%m-%d %H:%M:%S") if m.edit_date else None,
+                int(m.edit_date.timestamp()) if m.edit_date else None,
+                m.content,
+                m.reply_to,
+                m.user.id,
+                m.media.id if m.media else None)
+
+    def _get_user(self, id) -> User:
+        """Get a user from the user cache, or an empty User if it doesn't exist."""
+        if self._user_cache is None:
+            self._load_users()
+
+        u = self._user_cache.get(id)
+        if u is None:
+            u = self._user_cache[id] = User(id=id, username=None, first_name=None,
+                                            last_name=None, tags=[], avatar=None)
+        return u
+
     def _make_message(self, m) -> Message:
         """Makes a Message() object from an SQL result tuple."""
-        id, typ, date, edit_date, content, reply_to, \
-            user_id, username, first_name, last_name, tags, avatar, \
-            media_id, media_type, media_url, media_title, media_description, media_thumb = m
+        id, typ, ts, edit_ts, content, reply_to, user_id, \
+            media_id, media_type, media_url, media_title, media_description, media_thumb, \
+            media_size, media_mime, media_width, media_height = m
 
         md = None
         if media_id:
             desc = media_description
             if media_type == "poll":
-                desc = json.loads(media_description)
+                desc = _PollOptions(media_description)
 
             md = Media(id=media_id,
                        type=media_type,
                        url=media_url,
                        title=media_title,
                        description=desc,
-                       thumb=media_thumb)
-
-        date = pytz.utc.localize(date) if date else None
-        edit_date = pytz.utc.localize(edit_date) if edit_date else None
-
-        if self.tz:
-            date = date.astimezone(self.tz) if date else None
-            edit_date = edit_date.astimezone(self.tz) if edit_date else None
+                       thumb=media_thumb,
+                       size=media_size,
+                       mime=media_mime,
+                       width=media_width,
+                       height=media_height)
 
         return Message(id=id,
                        type=typ,
-                       date=date,
-                       edit_date=edit_date,
+                       date=self._zone.date(ts),
+                       edit_date=self._zone.date(edit_ts) if edit_ts is not None else None,
                        content=content,
                        reply_to=reply_to,
-                       user=User(id=user_id,
-                                 username=username,
-                                 first_name=first_name,
-                                 last_name=last_name,
-                                 tags=tags,
-                                 avatar=avatar),
-                       media=md)
+                       user=self._get_user(user_id),
+                       media=md,
+                       day=self._zone.day(ts))
@@ -1,12 +1,44 @@
 (function() {
 	// Hide the open burger menu when clicking nav links. 
 	const burger = document.querySelector("#burger");
-	document.querySelectorAll(".timeline a, .dayline a").forEach((e) => {
-		e.onclick = () => {
-			burger.checked = false;
-		};
+	function hideBurger(sel) {
+		document.querySelectorAll(sel).forEach((e) => {
+			e.onclick = () => {
+				burger.checked = false;
+			};
+		});
+	}
+	hideBurger(".timeline a, .dayline a");
+
+	// With publish_nav_include, the pagination is drawn here and the timeline,
+	// which is published once for all pages, is loaded into the sidebar.
+	document.querySelectorAll(".pagination[data-total]").forEach((ul) => {
+		const cur = parseInt(ul.dataset.current), total = parseInt(ul.dataset.total);
+		for (let p = 1; p <= total; p++) {
+			const li = document.createElement("li"), a = document.createElement("a");
+			a.href = `${ul.dataset.month}${p > 1 ? "_" + p : ""}.html`;
+			a.textContent = p;
+			if (p === cur) {
+				li.className = "active";
+			}
+			li.appendChild(a);
+			ul.appendChild(li);
+		}
 	});
 
+	const tl = document.querySelector(".timeline[data-include]");
+	if (tl) {
+		const month = tl.dataset.month;
+		fetch(tl.dataset.include).then((r) => r.text()).then((html) => {
+			tl.outerHTML = html;
+			const a = document.querySelector(`.timeline .months a[href="${month}.html"]`);
+			if (a) {
+				a.parentNode.classList.add("selected");
+			}
+			hideBurger(".timeline a");
+		});
+	}
+
 	// Change page anchor on scrolling past days.
 	let is = null;
 	document.onscroll = () => {
@@ -0,0 +1,147 @@
+(function() {
+	// Search the static index published in search/ by the build. The index
+	// is sharded by the first two characters of words (and big shards by
+	// longer prefixes) and only the shards of the words in the query are
+	// fetched (once).
+	const form = document.querySelector("#search");
+	if (!form) {
+		return;
+	}
+	const input = form.querySelector("input");
+	const results = form.querySelector(".results");
+	const maxResults = 100;
+	const files = {};
+
+	// Words in the query. This has to match _tokenize() in build.py.
+	function tokenize(s) {
+		return s.toLowerCase().normalize("NFC").match(/[\p{L}\p{M}\p{N}_]{2,}/gu) || [];
+	}
+
+	function shardName(t, n) {
+		return Array.from(t).slice(0, n).map((c) => c.codePointAt(0).toString(16)).join("-");
+	}
+
+	function load(name) {
+		if (!(name in files)) {
+			files[name] = fetch(`search/${name}.json`).then((r) => r.ok ? r.json() : {}).catch(() => ({}));
+		}
+		return files[name];
+	}
+
+	// Load a shard and all of its sub-shards.
+	async function subtree(name) {
+		const shard = await load(name);
+		const out = [shard];
+		for (const s of await Promise.all((shard[""] || []).map(subtree))) {
+			out.push(...s);
+		}
+		return out;
+	}
+
+	// Get the shards that may have the term t, or with prefix, the terms
+	// that start with it. A shard that's split lists its sub-shards, the
+	// shards of the prefixes one character longer, under the "" key.
+	async function shards(t, prefix) {
+		const n = Array.from(t).length;
+		const out = [];
+		let shard = await load(shardName(t, 2));
+		for (let i = 2; ; i++) {
+			out.push(shard);
+			const subs = shard[""];
+			if (!subs) {
+				break;
+			}
+
+			// All the sub-shards have terms that start with t.
+			if (i >= n) {
+				if (prefix) {
+					for (const s of await Promise.all(subs.map(subtree))) {
+						out.push(...s);
+					}
+				}
+				break;
+			}
+
+			const name = shardName(t, i + 1);
+			if (!subs.includes(name)) {
+				break;
+			}
+			shard = await load(name);
+		}
+		return out;
+	}
+
+	// Get the [message id, page index] of the messages that have all the words.
+	// The last word matches as a prefix as it may not have been typed fully.
+	async function search(q) {
+		const terms = tokenize(q);
+		if (terms.length === 0) {
+			return [];
+		}
+
+		let hits = null;
+		for (const [i, t] of terms.entries()) {
+			const last = i === terms.length - 1;
+			const found = new Map();
+			(await shards(t, last)).forEach((shard) => {
+				const keys = last ?
+					Object.keys(shard).filter((k) => k && k.startsWith(t)) :
+					(t in shard ? [t] : []);
+
+				keys.forEach((k) => {
+					const p = shard[k];
+					for (let j = 0; j < p.length; j += 2) {
+						found.set(p[j + 1], p[j]);
+					}
+				});
+			});
+
+			hits = hits === null ? found : new Map([...hits].filter(([id]) => found.has(id)));
+			if (hits.size === 0) {
+				break;
+			}
+		}
+
+		// Latest messages first.
+		return [...hits].sort((a, b) => b[0] - a[0]).slice(0, maxResults);
+	}
+
+	async function show() {
+		const q = input.value;
+		const [pages, hits] = await Promise.all([load("pages"), search(q)]);
+		if (q !== input.value) {
+			return;
+		}
+
+		results.innerHTML = "";
+		hits.forEach(([id, page]) => {
+			const a = document.createElement("a");
+			a.href = `${pages[page]}#${id}`;
+			a.textContent = `#${id}`;
+
+			const p = document.createElement("span");
+			p.className = "page";
+			p.textContent = pages[page].replace(".html", "");
+
+			const li = document.createElement("li");
+			li.append(a, p);
+			results.append(li);
+		});
+
+		if (hits.length === 0 && tokenize(q).length > 0) {
+			const li = document.createElement("li");
+			li.textContent = "No results.";
+			results.append(li);
+		}
+	}
+
+	let t = null;
+	input.oninput = () => {
+		window.clearTimeout(t);
+		t = window.setTimeout(show, 200);
+	};
+	form.onsubmit = (e) => {
+		e.preventDefault();
+		show();
+	};
+})();
@@ -0,0 +1,164 @@
+import json
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class _Phase:
+    """Times a block of code into a phase. Items can be added inside the block."""
+    __slots__ = ("m", "name", "items", "start")
+
+    def __init__(self, m, name, items):
+        self.m = m
+        self.name = name
+        self.items = items
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.m.add(self.name, time.perf_counter() - self.start, self.items)
+
+
+class _NoPhase:
+    __slots__ = ("items",)
+
+    def __init__(self):
+        self.items = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NO_PHASE = _NoPhase()
+
+
+class Metrics:
+    """
+    Wall time, number of calls and items processed (eg: messages) of the
+    phases of a sync or build, eg: "db.get_pages" or "sync.fetch". Phases
+    can overlap and run on several threads, so their times don't add up
+    to the run's wall time. Recording is a no-op until enable() is called.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = {}
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+        self._start = time.monotonic()
+
+    def phase(self, name, items=0):
+        """Return a context manager that times its block into the phase."""
+        if not self.enabled:
+            return _NO_PHASE
+        return _Phase(self, name, items)
+
+    def add(self, name, seconds, items=0, calls=1):
+        if not self.enabled:
+            return
+
+        with self._lock:
+            p = self.phases.get(name)
+            if p is None:
+                self.phases[name] = [seconds, calls, items]
+            else:
+                p[0] += seconds
+                p[1] += calls
+                p[2] += items
+
+    def merge(self, phases):
+        """Add the phases recorded by another process, eg: a build worker."""
+        for name, (seconds, calls, items) in phases.items():
+            self.add(name, seconds, items, calls)
+
+    def take(self) -> dict:
+        """Return the phases recorded so far and start over."""
+        with self._lock:
+            phases, self.phases = self.phases, {}
+        return phases
+
+    def peak_memory(self) -> int:
+        """Peak resident memory (bytes) of this process and of its largest child, eg: a worker."""
+        if not resource:
+            return None
+
+        # ru_maxrss is in KB on Linux and in bytes on macOS.
+        scale = 1 if os.uname().sysname == "Darwin" else 1024
+        return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+    def report(self, command) -> dict:
+        wall = time.monotonic() - self._start
+        phases = {}
+        for name, (seconds, calls, items) in sorted(self.phases.items()):
+            phases[name] = {"seconds": round(seconds, 6),
+                            "calls": calls,
+                            "items": items,
+                            "items_per_second": round(items / seconds, 1) if items and seconds else None}
+
+        return {"command": command,
+                "timestamp": int(time.time()),
+                "wall_seconds": round(wall, 6),
+                "peak_memory_bytes": self.peak_memory(),
+                "phases": phases}
+
+    def write(self, fname, command):
+        """
+        Write the report to fname, as JSON, or in the Prometheus text format
+        if the file ends with .prom (eg: for node_exporter's textfile
+        collector). The file is replaced atomically.
+        """
+        r = self.report(command)
+        if fname.endswith(".prom"):
+            data = _prometheus(r)
+        else:
+            data = json.dumps(r, indent=2) + "\n"
+
+        tmp = fname + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, fname)
+
+
+def _prometheus(r) -> str:
+    cmd = 'command="{}"'.format(r["command"])
+    out = []
+
+    def metric(name, typ, help, values):
+        out.append("# HELP tgarchive_{} {}".format(name, help))
+        out.append("# TYPE tgarchive_{} {}".format(name, typ))
+        for labels, v in values:
+            out.append("tgarchive_{}{{{}}} {}".format(name, labels, v))
+
+    phases = [('{},phase="{}"'.format(cmd, name), p) for name, p in r["phases"].items()]
+    metric("phase_seconds", "gauge", "Wall time spent in the phase in the last run.",
+           [(l, p["seconds"]) for l, p in phases])
+    metric("phase_calls", "gauge", "Number of times the phase ran in the last run.",
+           [(l, p["calls"]) for l, p in phases])
+    metric("phase_items", "gauge", "Number of items (eg: messages) processed by the phase in the last run.",
+           [(l, p["items"]) for l, p in phases])
+    metric("run_seconds", "gauge", "Wall time of the last run.", [(cmd, r["wall_seconds"])])
+    if r["peak_memory_bytes"] is not None:
+        metric("peak_memory_bytes", "gauge", "Peak resident memory of the last run.",
+               [(cmd, r["peak_memory_bytes"])])
+    metric("last_run_timestamp_seconds", "gauge", "Unix time at which the last run finished.",
+           [(cmd, r["timestamp"])])
+
+    return "\n".join(out) + "\n"
+
+
+# Metrics of the current run, recorded by the DB, sync and build when enabled by the CLI.
+metrics = Metrics()
@@ -1,17 +1,80 @@
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
+from functools import partial
 from sys import exit
+import asyncio
 import json
 import logging
+import math
+import mimetypes
 import os
 import tempfile
 import shutil
 import time
 
 from PIL import Image
-from telethon import TelegramClient, errors, sync
+from telethon import TelegramClient, errors, events, sync
+from telethon.utils import get_peer_id, resolve_id
 import telethon.tl.types
 
 from .db import User, Message, Media
+from .metrics import metrics
+
+
+# Number of fetched batches that can wait to be transformed.
+_QUEUE_SIZE = 2
+
+# Number of messages transformed between the turns given to the event loop
+# for the fetchers to make progress.
+_TRANSFORM_CHUNK = 200
+
+
+class _RateControl:
+    """
+    _RateControl adapts the number of messages fetched per batch and the wait
+    between batches to the server's responses. Flood waits halve the batch
+    size and double the wait. Batches that go through grow the batch size
+    back up to its maximum and halve the wait, down to no wait at all.
+
+    Telethon sleeps through short flood waits on its own, so requests that
+    take much longer than usual are also taken as flood waits.
+
+    At most `concurrency` requests are made at a time by all the fetchers
+    sharing the rate control.
+    """
+    MIN_BATCH_SIZE = 100
+    MAX_WAIT = 60
+
+    def __init__(self, batch_size, wait, concurrency):
+        self.max_batch_size = max(batch_size, self.MIN_BATCH_SIZE)
+        self.batch_size = self.max_batch_size
+        self.wait = wait
+        self.requests = asyncio.Semaphore(concurrency)
+
+        # Moving average of the seconds per request (of up to 100 messages).
+        self._latency = None
+
+    def on_batch(self, n, seconds):
+        """Record a batch of n messages that was fetched in the given seconds."""
+        if n == 0:
+            return
+
+        latency = seconds / math.ceil(n / 100)
+        last = self._latency
+        self._latency = latency if last is None else last * 0.8 + latency * 0.2
+
+        # Flood waits that were slept through take at least a second.
+        if last is not None and latency > last * 3 and latency > last + 1:
+            self.on_flood()
+            return
+
+        self.batch_size = min(self.batch_size + self.MIN_BATCH_SIZE, self.max_batch_size)
+        self.wait = self.wait / 2 if self.wait >= 1 else 0
+
+    def on_flood(self):
+        """Record a flood wait."""
+        self.batch_size = max(self.batch_size // 2, self.MIN_BATCH_SIZE)
+        self.wait = min(max(self.wait * 2, 1), self.MAX_WAIT)
 
 
 class Sync:
@@ -22,77 +85,318 @@ class Sync:
     config = {}
     db = None
 
-    def __init__(self, config, session_file, db):
+    def __init__(self, config, session_file, db, client=None, share=None):
         self.config = config
         self.db = db
 
-        self.client = self.new_client(session_file, config)
+        # Messages of the batch being transformed whose media rows are written
+        # as pending with the batch, to be queued for download once it's written.
+        self._media_msgs = []
+
+        # Media downloads queued or in progress on the client's event loop.
+        self._media_tasks = set()
+        self._media_sem = None
+
+        # Map of user ID -> (profile photo ID, file) of the avatars downloaded
+        # so far. An avatar is only downloaded again if the photo ID changes.
+        # Avatars that are still being saved are only cached once they are, so
+        # that failed saves are downloaded again.
+        self._avatars = db.get_avatars()
+        self._avatar_saves = {}
+
+        # IDs of the messages that have been updated (new or edited) and
+        # deleted in the watched group, and not yet written to the DB.
+        self._updated_ids = set()
+        self._deleted_ids = set()
+        self._updates = None
+
+        # Progress of the current sync (messages written, the last one, and the
+        # start time) and the last batch handed to the writer with its media.
+        self._n, self._last, self._start = 0, None, 0
+        self._pending = None
+
+        # Prefix of the log messages, to tell groups apart in sync_groups().
+        self._prefix = ""
+
+        # All DB writes are made in order on a single writer thread, so that a
+        # batch is written while the next ones are fetched and transformed.
+        self._writer = ThreadPoolExecutor(max_workers=1)
+
+        # The client can be passed in, eg: to drive the sync with a local client.
+        # With share, the client and the fetch rate control of another Sync are
+        # shared, eg: to sync several groups at once.
+        if share:
+            self.client = share.client
+            self._rate = share._rate
+        else:
+            self.client = client if client else self.new_client(session_file, config)
+            self._rate = _RateControl(config["fetch_batch_size"], config["fetch_wait"],
+                                      config["fetch_concurrency"])
 
         if not os.path.exists(self.config["media_dir"]):
             os.mkdir(self.config["media_dir"])
 
-    def sync(self, ids=None, from_id=None):
+    def sync(self, ids=None, from_id=None, segments=1):
         """
         Sync syncs messages from Telegram from the last synced message
-        into the local SQLite DB.
+        into the local SQLite DB. With segments > 1, the history up to the
+        latest message is first backfilled in that many concurrent segments.
         """
+        group = self._get_group(self.config["group"])
+        start = time.monotonic()
+
+        if not ids:
+            fetchers, batches = self._backfill(group, from_id, segments)
+            if fetchers:
+                _sync_batches([self], fetchers, batches)
+                logging.info("backfilled {} messages".format(self._n))
+
+                # Continue from the last backfilled message, unless the backfill
+                # was stopped by fetch_limit.
+                from_id = None
+                if 0 < self.config["fetch_limit"] <= self._n:
+                    self._finish_sync()
+                    return
+
+        fetchers, batches = self._fetch(group, ids, from_id)
+        _sync_batches([self], fetchers, batches)
+
+        self._finish_sync()
+        logging.info(
+            "finished. fetched {} messages ({:.1f}/s). last message = {}".format(
+                self._n, self._n / (time.monotonic() - start),
+                self._last.date if self._last else None))
 
+    def _fetch(self, group, ids=None, from_id=None, batches=None):
+        """
+        Start fetching the messages from the last synced message (or from_id,
+        or the given ids) into the batches queue. Returns the (sync, fetcher
+        task) in a list, and the queue.
+        """
         if ids:
-            last_id, last_date = (ids, None)
+            last_id = 0
             logging.info("fetching message id={}".format(ids))
         elif from_id:
-            last_id, last_date = (from_id, None)
+            last_id = from_id
             logging.info("fetching from last message id={}".format(last_id))
         else:
             last_id, last_date = self.db.get_last_message_id()
-            logging.info("fetching from last message id={} ({})".format(
-                last_id, last_date))
+            logging.info("{}fetching from last message id={} ({})".format(
+                self._prefix, last_id, last_date))
 
-        group_id = self._get_group_id(self.config["group"])
+        batches = batches or asyncio.Queue(_QUEUE_SIZE)
+        return [(self, self.client.loop.create_task(
+            self._fetch_batches(group, last_id or 0, ids, batches)))], batches
 
-        n = 0
-        while True:
-            has = False
-            for m in self._get_messages(group_id,
-                                        offset_id=last_id if last_id else 0,
-                                        ids=ids):
-                if not m:
-                    continue
+    def _backfill(self, group, from_id, segments, batches=None):
+        """
+        Start backfilling the messages from from_id (or the last synced
+        message) up to the latest one by splitting the ID range into segments
+        that are fetched concurrently into the batches queue. Each segment's
+        progress is checkpointed in the DB, and an interrupted backfill is
+        resumed before anything else. Returns the (sync, fetcher task) of each
+        segment (none if there's nothing to backfill), and the queue.
+        """
+        batches = batches or asyncio.Queue(_QUEUE_SIZE)
+
+        pending = self.db.get_segments()
+        if pending:
+            logging.info("{}resuming the backfill of {} segments".format(self._prefix, len(pending)))
+        elif segments > 1:
+            first = from_id or self.db.get_last_message_id()[0] or 0
+            latest = self.client.get_messages(group, limit=1)
+            if not latest or latest[0].id <= first:
+                return [], batches
+
+            # Segments are ID ranges of (last_id, max_id].
+            last = latest[0].id
+            bounds = [first + (last - first) * i // segments for i in range(segments + 1)]
+            self.db.insert_segments([(bounds[i], bounds[i + 1]) for i in range(segments)
+                                     if bounds[i] < bounds[i + 1]])
+            pending = self.db.get_segments()
+            logging.info("backfilling messages {} to {} in {} segments".format(
+                first + 1, last, len(pending)))
+
+        return [(self, self.client.loop.create_task(
+                self._fetch_batches(group, last_id, None, batches, max_id, id)))
+                for id, last_id, max_id in pending], batches
+
+    def _write_batch(self, batch, segment=None):
+        """Write a batch of messages and checkpoint its backfill segment (on the writer thread)."""
+        self.db.insert_messages(batch)
+        if segment is not None:
+            self.db.set_segment(segment, batch[-1].id)
+
+    def _on_batch(self, segment, msgs) -> bool:
+        """
+        Transform a fetched batch of messages and hand it to the writer once
+        the last batch has been written. Returns False once fetch_limit is
+        reached.
+        """
+        batch = []
+        with metrics.phase("sync.transform") as p:
+            for m in msgs:
+                batch.append(self._make_message(m))
+                if 0 < self.config["fetch_limit"] <= self._n + len(batch):
+                    break
+
+                # The fetchers only run on the loop, which is stopped meanwhile.
+                if len(batch) % _TRANSFORM_CHUNK == 0:
+                    self.client.loop.run_until_complete(asyncio.sleep(0))
+            p.items = len(batch)
+
+        self._flush()
+        self._pending = (self._write(self._write_batch, batch, segment), self._media_msgs)
+        self._media_msgs = []
+
+        self._n += len(batch)
+        self._last = batch[-1]
+
+        if 0 < self.config["fetch_limit"] <= self._n:
+            return False
+
+        logging.info("{}fetched {} messages ({:.1f}/s). batch size {}, waiting {:.1f} seconds between batches".format(
+            self._prefix, self._n, self._n / (time.monotonic() - self._start),
+            self._rate.batch_size, self._rate.wait))
+        return True
+
+    def _on_done(self, segment):
+        """Mark a backfill segment as done once all its batches are written."""
+        if segment is not None:
+            self._flush()
+            self._wait(self._write(self.db.delete_segment, segment))
+
+    def _flush(self):
+        """Wait for the last batch to be written and queue its media for download."""
+        if self._pending:
+            write, media = self._pending
+            self._pending = None
+            with metrics.phase("sync.wait_write"):
+                self._wait(write)
+            self._queue_downloads(media)
+
+    def _finish_sync(self, takeout=True):
+        self._finish_downloads()
+        self._wait(self._write(self.db.commit))
+        if takeout and self.config.get("use_takeout", False):
+            self.finish_takeout()
+
+    def sync_media(self):
+        """
+        Retry the downloads of all media that is pending or failed
+        in the local DB, for instance, from an interrupted sync.
+        """
+        ids = self.db.get_incomplete_media()
+        logging.info("downloading {} pending media".format(len(ids)))
+
+        group = self._get_group(self.config["group"])
+        for i in range(0, len(ids), 100):
+            chunk = ids[i:i + 100]
+            msgs = []
+            for id, m in zip(chunk, self.client.get_messages(group, ids=chunk)):
+                if m and m.media:
+                    msgs.append(m)
+                else:
+                    logging.info("media #{} no longer exists".format(id))
+                    self._write(self.db.set_media_status, id, "failed")
 
-                has = True
+            self._queue_downloads(msgs)
 
-                # Insert the records into DB.
-                self.db.insert_user(m.user)
+        self._finish_downloads()
+        self._wait(self._write(self.db.commit))
+        if self.config.get("use_takeout", False):
+            self.finish_takeout()
 
-                if m.media:
-                    self.db.insert_media(m.media)
+    def watch(self, on_change):
+        """
+        Watch the group for new, edited and deleted messages, writing them to
+        the local DB as they happen, after syncing the messages missed since
+        the last sync. Once the updates have settled for watch_debounce seconds,
+        on_change() is called, eg: to rebuild the site.
+        """
+        group = self._get_group(self.config["group"])
+        group_id = get_peer_id(group, add_mark=False)
+        is_channel = isinstance(group, telethon.tl.types.InputPeerChannel)
+
+        # The update handlers only collect message IDs. The messages are fetched
+        # and written outside the event loop with the regular sync code.
+        self._updates = asyncio.Event()
+
+        async def on_message(event):
+            self._updated_ids.add(event.message.id)
+            self._updates.set()
+
+        async def on_delete(event):
+            # Deletions in basic groups don't carry the chat, but their message
+            # IDs are unique across all of the user's basic groups and chats.
+            if event.chat_id is None:
+                if is_channel:
+                    return
+            elif resolve_id(event.chat_id)[0] != group_id:
+                return
+
+            self._deleted_ids.update(event.deleted_ids)
+            self._updates.set()
+
+        self.client.add_event_handler(on_message, events.NewMessage(chats=group))
+        self.client.add_event_handler(on_message, events.MessageEdited(chats=group))
+        self.client.add_event_handler(on_delete, events.MessageDeleted())
+
+        # Catch up with the handlers in place so that no update is missed.
+        self.sync()
+        on_change()
+
+        logging.info("watching for new messages")
+        while True:
+            self.client.loop.run_until_complete(self._wait_for_updates())
 
-                self.db.insert_message(m)
+            updated, deleted = self._updated_ids - self._deleted_ids, self._deleted_ids
+            self._updated_ids, self._deleted_ids = set(), set()
+            self._updates.clear()
 
-                last_date = m.date
-                n += 1
-                if n % 300 == 0:
-                    logging.info("fetched {} messages".format(n))
-                    self.db.commit()
+            self._apply_updates(group, sorted(updated), sorted(deleted))
+            on_change()
 
-                if 0 < self.config["fetch_limit"] <= n or ids:
-                    has = False
-                    break
+    async def _wait_for_updates(self):
+        """
+        Wait for updates and then until no more have arrived for watch_debounce
+        seconds, so that a burst of updates is written and published at once.
+        The wait is capped at 10x watch_debounce.
+        """
+        await self._updates.wait()
+
+        wait = self.config["watch_debounce"]
+        end = self.client.loop.time() + wait * 10
+        n = -1
+        while n != len(self._updated_ids) + len(self._deleted_ids) and \
+                self.client.loop.time() < end:
+            n = len(self._updated_ids) + len(self._deleted_ids)
+            await asyncio.sleep(wait)
+
+    def _apply_updates(self, group, updated, deleted):
+        """Fetch and write updated messages and delete deleted ones from the local DB."""
+        deleted = set(deleted)
+        n = 0
+        for i in range(0, len(updated), 100):
+            chunk = updated[i:i + 100]
+            msgs = self.client.loop.run_until_complete(self._fetch_messages(group, 0, chunk))
+            batch = [self._make_message(m) for m in msgs if m]
 
-            self.db.commit()
-            if has:
-                last_id = m.id
-                logging.info("fetched {} messages. sleeping for {} seconds".format(
-                    n, self.config["fetch_wait"]))
-                time.sleep(self.config["fetch_wait"])
-            else:
-                break
+            # Messages that can't be fetched have been deleted since.
+            deleted.update(set(chunk) - set(m.id for m in batch))
 
-        self.db.commit()
-        if self.config.get("use_takeout", False):
-            self.finish_takeout()
-        logging.info(
-            "finished. fetched {} messages. last message = {}".format(n, last_date))
+            self._wait(self._write(self.db.insert_messages, batch))
+            self._queue_downloads(self._media_msgs)
+            self._media_msgs = []
+            n += len(batch)
+
+        removed = 0
+        if deleted:
+            removed = self._wait(self._write(self.db.delete_messages, sorted(deleted)))
+
+        self._finish_downloads()
+        self._wait(self._write(self.db.commit))
+        logging.info("updated {} messages, deleted {}".format(n, removed))
 
     def new_client(self, session, config):
         if "proxy" in config and config["proxy"].get("enable"):
@@ -141,66 +445,95 @@ class Sync:
     def finish_takeout(self):
         self.client.__exit__(None, None, None)
 
-    def _get_messages(self, group, offset_id, ids=None) -> Message:
-        messages = self._fetch_messages(group, offset_id, ids)
+    def _make_message(self, m) -> Message:
         # https://docs.telethon.dev/en/latest/quick-references/objects-reference.html#message
-        for m in messages:
-            if not m:
-                continue
+        # Media.
+        sticker = None
+        med = None
+        if m.media:
+            # If it's a sticker, get the alt value (unicode emoji).
+            if isinstance(m.media, telethon.tl.types.MessageMediaDocument) and \
+                    hasattr(m.media, "document") and \
+                    m.media.document.mime_type == "application/x-tgsticker":
+                alt = [a.alt for a in m.media.document.attributes if isinstance(
+                    a, telethon.tl.types.DocumentAttributeSticker)]
+                if len(alt) > 0:
+                    sticker = alt[0]
+            elif isinstance(m.media, telethon.tl.types.MessageMediaPoll):
+                med = self._make_poll(m)
+            else:
+                med = self._get_media(m)
+
+        # Message.
+        typ = "message"
+        if m.action:
+            if isinstance(m.action, telethon.tl.types.MessageActionChatAddUser):
+                typ = "user_joined"
+            elif isinstance(m.action, telethon.tl.types.MessageActionChatJoinedByLink):
+                typ = "user_joined_by_link"
+            elif isinstance(m.action, telethon.tl.types.MessageActionChatDeleteUser):
+                typ = "user_left"
+
+        return Message(
+            type=typ,
+            id=m.id,
+            date=m.date,
+            edit_date=m.edit_date,
+            content=sticker if sticker else m.raw_text,
+            reply_to=m.reply_to_msg_id if m.reply_to and m.reply_to.reply_to_msg_id else None,
+            user=self._get_user(m.sender, m.chat),
+            media=med
+        )
 
-            # Media.
-            sticker = None
-            med = None
-            if m.media:
-                # If it's a sticker, get the alt value (unicode emoji).
-                if isinstance(m.media, telethon.tl.types.MessageMediaDocument) and \
-                        hasattr(m.media, "document") and \
-                        m.media.document.mime_type == "application/x-tgsticker":
-                    alt = [a.alt for a in m.media.document.attributes if isinstance(
-                        a, telethon.tl.types.DocumentAttributeSticker)]
-                    if len(alt) > 0:
-                        sticker = alt[0]
-                elif isinstance(m.media, telethon.tl.types.MessageMediaPoll):
-                    med = self._make_poll(m)
-                else:
-                    med = self._get_media(m)
-
-            # Message.
-            typ = "message"
-            if m.action:
-                if isinstance(m.action, telethon.tl.types.MessageActionChatAddUser):
-                    typ = "user_joined"
-                elif isinstance(m.action, telethon.tl.types.MessageActionChatJoinedByLink):
-                    typ = "user_joined_by_link"
-                elif isinstance(m.action, telethon.tl.types.MessageActionChatDeleteUser):
-                    typ = "user_left"
-
-            yield Message(
-                type=typ,
-                id=m.id,
-                date=m.date,
-                edit_date=m.edit_date,
-                content=sticker if sticker else m.raw_text,
-                reply_to=m.reply_to_msg_id if m.reply_to and m.reply_to.reply_to_msg_id else None,
-                user=self._get_user(m.sender, m.chat),
-                media=med
-            )
+    async def _fetch_batches(self, group, offset_id, ids, batches, max_id=None, segment=None):
+        """
+        Fetch batches of messages after offset_id (up to max_id) into the
+        batches queue as (sync, segment, messages), waiting between them as
+        set by the rate control, until there are no more messages. The end
+        is marked with (sync, segment, None).
+        """
+        while True:
+            msgs = await self._fetch_messages(group, offset_id, ids, max_id)
+            msgs = [m for m in msgs if m]
+            if msgs:
+                await batches.put((self, segment, msgs))
 
-    def _fetch_messages(self, group, offset_id, ids=None) -> Message:
-        try:
-            if self.config.get("use_takeout", False):
-                wait_time = 0
-            else:
-                wait_time = None
-            messages = self.client.get_messages(group, offset_id=offset_id,
-                                                limit=self.config["fetch_batch_size"],
-                                                wait_time=wait_time,
-                                                ids=ids,
-                                                reverse=True)
-            return messages
-        except errors.FloodWaitError as e:
-            logging.info(
-                "flood waited: have to wait {} seconds".format(e.seconds))
+            if not msgs or ids:
+                break
+
+            offset_id = msgs[-1].id
+            await asyncio.sleep(self._rate.wait)
+
+        await batches.put((self, segment, None))
+
+    async def _fetch_messages(self, group, offset_id, ids=None, max_id=None) -> list:
+        if self.config.get("use_takeout", False):
+            wait_time = 0
+        else:
+            wait_time = None
+
+        # Retry flood waits after waiting for as long as the server asks.
+        while True:
+            try:
+                async with self._rate.requests:
+                    start = time.monotonic()
+                    # max_id is exclusive.
+                    messages = await self.client.get_messages(group, offset_id=offset_id,
+                                                              max_id=max_id + 1 if max_id else 0,
+                                                              limit=self._rate.batch_size,
+                                                              wait_time=wait_time,
+                                                              ids=ids,
+                                                              reverse=True)
+                self._rate.on_batch(len(messages), time.monotonic() - start)
+                metrics.add("sync.fetch", time.monotonic() - start, len(messages))
+                return messages
+            except errors.FloodWaitError as e:
+                self._rate.on_flood()
+                logging.info(
+                    "flood waited: have to wait {} seconds. retrying with batch size {}".format(
+                        e.seconds, self._rate.batch_size))
+                with metrics.phase("sync.flood_wait"):
+                    await asyncio.sleep(e.seconds)
 
     def _get_user(self, u, chat) -> User:
         tags = []
@@ -212,7 +545,7 @@ class Sync:
             chat.title != ''
             ):
                 tags.append("group_self")
-                avatar = self._downloadAvatarForUserOrChat(chat)
+                avatar = self._get_avatar(chat)
                 return User(
                     id=chat.id,
                     username=chat.title,
@@ -245,7 +578,7 @@ class Sync:
             tags.append("fake")
 
         # Download sender's profile photo if it's not already cached.
-        avatar = self._downloadAvatarForUserOrChat(u)
+        avatar = self._get_avatar(u)
 
         return User(
             id=u.id,
@@ -303,45 +636,120 @@ class Sync:
                                 "skipping media #{} / {}".format(msg.file.name, msg.file.mime_type))
                             return
 
-                logging.info("downloading media #{}".format(msg.id))
-                try:
-                    basename, fname, thumb = self._download_media(msg)
-                    return Media(
-                        id=msg.id,
-                        type="photo",
-                        url=fname,
-                        title=basename,
-                        description=None,
-                        thumb=thumb
-                    )
-                except Exception as e:
-                    logging.error(
-                        "error downloading media: #{}: {}".format(msg.id, e))
-
-    def _download_media(self, msg) -> [str, str, str]:
+                size = self.config["media_max_size"] * 1024 * 1024
+                if size and msg.file and msg.file.size and msg.file.size > size:
+                    logging.info(
+                        "skipping media #{} / {} bytes".format(msg.id, msg.file.size))
+                    return
+
+                # The media is written as pending with the message and downloaded
+                # in the background once the message batch has been written.
+                self._media_msgs.append(msg)
+                return Media(
+                    id=msg.id,
+                    type="photo",
+                    url=None,
+                    title=msg.file.name if msg.file else None,
+                    description=None,
+                    thumb=None,
+                    status="pending"
+                )
+
+    def _queue_downloads(self, msgs):
         """
-        Download a media / file attached to a message and return its original
-        filename, sanitized name on disk, and the thumbnail (if any). 
+        Queue the downloads of the media of the messages of a written batch.
+        At most media_concurrency files are downloaded at a time while the message
+        sync carries on. If the downloads fall behind by more than a batch,
+        wait for them to catch up.
+        """
+        if self._media_sem is None:
+            self._media_sem = asyncio.Semaphore(self.config["media_concurrency"])
+
+        for msg in msgs:
+            t = self.client.loop.create_task(self._download_media_task(msg))
+            self._media_tasks.add(t)
+            t.add_done_callback(self._media_tasks.discard)
+
+        while len(self._media_tasks) > self.config["fetch_batch_size"]:
+            self.client.loop.run_until_complete(asyncio.wait(
+                self._media_tasks, return_when=asyncio.FIRST_COMPLETED))
+
+    def _finish_downloads(self):
+        """Wait for all queued media downloads to finish."""
+        if self._media_tasks:
+            logging.info("waiting for {} media downloads".format(len(self._media_tasks)))
+            self.client.loop.run_until_complete(asyncio.wait(self._media_tasks))
+
+    def _write(self, fn, *args):
+        """Queue a DB write on the writer thread and return its future."""
+        return self._writer.submit(fn, *args)
+
+    def _wait(self, f):
+        """Wait for a DB write while running the event loop and return its result."""
+        return self.client.loop.run_until_complete(asyncio.wrap_future(f))
+
+    async def _download_media_task(self, msg):
+        async with self._media_sem:
+            logging.info("downloading media #{}".format(msg.id))
+            try:
+                with metrics.phase("sync.download_media") as p:
+                    media = await self._download_media(msg)
+                    p.items = media.size
+                await asyncio.wrap_future(self._write(self.db.insert_media, media))
+            except Exception as e:
+                logging.error(
+                    "error downloading media: #{}: {}".format(msg.id, e))
+                self._write(self.db.set_media_status, msg.id, "failed")
+
+    async def _download_media(self, msg) -> Media:
+        """
+        Download a media / file attached to a message and return it with its
+        original filename, sanitized name on disk, the thumbnail (if any), and
+        the size, MIME type and dimensions of the file.
         """
         # Download the media to the temp dir and copy it back as
         # there does not seem to be a way to get the canonical
         # filename before the download.
-        fpath = self.client.download_media(msg, file=tempfile.gettempdir())
+        fpath = await self.client.download_media(msg, file=tempfile.gettempdir())
         basename = os.path.basename(fpath)
 
         newname = "{}.{}".format(msg.id, self._get_file_ext(basename))
-        shutil.move(fpath, os.path.join(self.config["media_dir"], newname))
+        newpath = os.path.join(self.config["media_dir"], newname)
+        shutil.move(fpath, newpath)
+
+        f = msg.file
+        mime = f.mime_type if f and f.mime_type else mimetypes.guess_type(newname)[0]
+        width = f.width if f else None
+        height = f.height if f else None
 
-        # If it's a photo, download the thumbnail.
+        # If it's a photo, make the thumbnail from the downloaded file
+        # instead of downloading it again.
         tname = None
         if isinstance(msg.media, telethon.tl.types.MessageMediaPhoto):
-            tpath = self.client.download_media(
-                msg, file=tempfile.gettempdir(), thumb=1)
-            tname = "thumb_{}.{}".format(
-                msg.id, self._get_file_ext(os.path.basename(tpath)))
-            shutil.move(tpath, os.path.join(self.config["media_dir"], tname))
+            tname = "thumb_{}.jpg".format(msg.id)
+            width, height = await self.client.loop.run_in_executor(
+                None, self._make_thumb, newpath, os.path.join(self.config["media_dir"], tname))
+
+        return Media(
+            id=msg.id,
+            type="photo",
+            url=newname,
+            title=basename,
+            description=None,
+            thumb=tname,
+            size=os.path.getsize(newpath),
+            mime=mime,
+            width=width,
+            height=height
+        )
 
-        return basename, newname, tname
+    def _make_thumb(self, src, dst) -> [int, int]:
+        """Make a thumbnail of an image and return the dimensions of the original."""
+        im = Image.open(src)
+        size = im.size
+        im.thumbnail(self.config["media_thumb_size"], Image.LANCZOS)
+        im.convert("RGB").save(dst, "JPEG")
+        return size
 
     def _get_file_ext(self, f) -> str:
         if "." in f:
@@ -351,40 +759,122 @@ class Sync:
 
         return ".file"
 
-    def _download_avatar(self, user):
+    def _get_avatar(self, entity):
+        """
+        Get the avatar file of a user or chat, downloading it only if the
+        profile photo has changed since the last download.
+        """
+        if not self.config["download_avatars"]:
+            return None
+
+        photo_id = getattr(getattr(entity, "photo", None), "photo_id", None)
+        if photo_id is None:
+            return None
+
+        cached = self._avatar_saves.get(entity.id) or self._avatars.get(entity.id)
+        if cached and cached[0] == photo_id:
+            return cached[1]
+
+        fname = None
+        try:
+            with metrics.phase("sync.download_avatar"):
+                fname = self._download_avatar(entity, photo_id)
+        except Exception as e:
+            logging.error(
+                "error downloading avatar: #{}: {}".format(entity.id, e))
+            return None
+
+        if fname is None:
+            self._cache_avatar(entity.id, photo_id, None)
+        return fname
+
+    def _cache_avatar(self, id, photo_id, fname):
+        self._avatars[id] = (photo_id, fname)
+        self._write(self.db.insert_avatar, id, photo_id, fname)
+
+    def _on_avatar_saved(self, id, photo_id, fname, f):
+        if self._avatar_saves.get(id) == (photo_id, fname):
+            del self._avatar_saves[id]
+        if not f.cancelled() and f.result():
+            self._cache_avatar(id, photo_id, fname)
+
+    def _download_avatar(self, user, photo_id):
         fname = "avatar_{}.jpg".format(user.id)
         fpath = os.path.join(self.config["media_dir"], fname)
 
-        if os.path.exists(fpath):
-            return fname
-
         logging.info("downloading avatar #{}".format(user.id))
 
-        # Download the file into a container, resize it, and then write to disk.
+        # Download the file into a container, and resize and write it
+        # to disk off the event loop.
         b = BytesIO()
         profile_photo = self.client.download_profile_photo(user, file=b)
         if profile_photo is None:
             logging.info("user has no avatar #{}".format(user.id))
             return None
 
-        im = Image.open(b)
-        im.thumbnail(self.config["avatar_size"], Image.LANCZOS)
-        im.save(fpath, "JPEG")
+        f = self.client.loop.run_in_executor(None, self._save_avatar, b, fpath)
+        self._media_tasks.add(f)
+        f.add_done_callback(self._media_tasks.discard)
+        self._avatar_saves[user.id] = (photo_id, fname)
+        f.add_done_callback(partial(self._on_avatar_saved, user.id, photo_id, fname))
 
         return fname
 
-    def _get_group_id(self, group):
+    def _save_avatar(self, b, fpath) -> bool:
+        try:
+            im = Image.open(b)
+            im.thumbnail(self.config["avatar_size"], Image.LANCZOS)
+            im.convert("RGB").save(fpath, "JPEG")
+            return True
+        except Exception as e:
+            logging.error("error saving avatar: {}: {}".format(fpath, e))
+            return False
+
+    def _get_group(self, group):
         """
-        Syncs the Entity cache and returns the Entity ID for the specified group,
-        which can be a str/int for group ID, group name, or a group username.
+        Get the input peer (ID and access hash) of the specified group, which
+        can be a str/int for group ID, group name, or a group username. The
+        peer is cached in the DB after it is first resolved, so that later
+        syncs don't have to resolve it again. A cached peer is checked with a
+        (cheap) lookup by ID, and if its access hash is no longer valid, eg:
+        after switching the session to another account, the group is resolved
+        again.
 
         The authorized user must be a part of the group.
         """
-        # Get all dialogs for the authorized user, which also
-        # syncs the entity cache to get latest entities
-        # ref: https://docs.telethon.dev/en/latest/concepts/entities.html#getting-entities
-        _ = self.client.get_dialogs()
+        cached = self.db.get_group(str(group))
+        if cached:
+            typ, id, access_hash = cached
+            if typ == "channel":
+                peer = telethon.tl.types.InputPeerChannel(id, access_hash)
+            elif typ == "chat":
+                peer = telethon.tl.types.InputPeerChat(id)
+            else:
+                peer = telethon.tl.types.InputPeerUser(id, access_hash)
 
+            try:
+                self.client.get_entity(peer)
+                return peer
+            except (ValueError, errors.BadRequestError) as e:
+                logging.info("{}the cached group is no longer valid ({}), resolving it again".format(
+                    self._prefix, e))
+                self.db.delete_group(str(group))
+
+        peer = self.client.get_input_entity(self._get_group_entity(group))
+        if isinstance(peer, telethon.tl.types.InputPeerChannel):
+            self.db.insert_group(str(group), "channel", peer.channel_id, peer.access_hash)
+        elif isinstance(peer, telethon.tl.types.InputPeerChat):
+            self.db.insert_group(str(group), "chat", peer.chat_id, None)
+        elif isinstance(peer, telethon.tl.types.InputPeerUser):
+            self.db.insert_group(str(group), "user", peer.user_id, peer.access_hash)
+
+        return peer
+
+    def _get_group_entity(self, group):
+        """
+        Resolve the Entity of the specified group. If it can't be resolved
+        directly, sync the Entity cache from the dialogs and try again.
+        """
         try:
             # If the passed group is a group ID, extract it.
             group = int(group)
@@ -394,22 +884,115 @@ class Sync:
             pass
 
         try:
-            entity = self.client.get_entity(group)
+            return self.client.get_entity(group)
+        except ValueError:
+            pass
+
+        # Get all dialogs for the authorized user, which also
+        # syncs the entity cache to get latest entities
+        # ref: https://docs.telethon.dev/en/latest/concepts/entities.html#getting-entities
+        logging.info("resolving the group from the dialogs")
+        _ = self.client.get_dialogs()
+
+        try:
+            return self.client.get_entity(group)
         except ValueError:
             logging.critical("the group: {} does not exist,"
                              " or the authorized user is not a participant!".format(group))
             # This is a critical error, so exit with code: 1
             exit(1)
 
-        return entity.id
 
-    def _downloadAvatarForUserOrChat(self, entity):
-        avatar = None
-        if self.config["download_avatars"]:
-            try:
-                fname = self._download_avatar(entity)
-                avatar = fname
-            except Exception as e:
-                logging.error(
-                    "error downloading avatar: #{}: {}".format(entity.id, e))
-        return avatar
+def sync_groups(syncs):
+    """
+    Sync the groups of several Syncs (sharing a client) at once from their
+    last synced messages, resuming any unfinished backfills. The groups'
+    batches are fetched concurrently and transformed and written as they
+    arrive, under the shared rate control.
+    """
+    batches = asyncio.Queue(_QUEUE_SIZE)
+    fetchers = []
+    for s in syncs:
+        s._prefix = "{}: ".format(s.config["group"])
+        group = s._get_group(s.config["group"])
+        f, _ = s._backfill(group, None, 1, batches)
+        if not f:
+            f, _ = s._fetch(group, batches=batches)
+        fetchers.extend(f)
+
+    _sync_batches(syncs, fetchers, batches)
+
+    for s in syncs:
+        s._finish_sync(takeout=False)
+        logging.info("{}finished. fetched {} messages. last message = {}".format(
+            s._prefix, s._n, s._last.date if s._last else None))
+
+    if syncs[0].config.get("use_takeout", False):
+        syncs[0].finish_takeout()
+
+
+def _sync_batches(syncs, fetchers, batches):
+    """
+    Transform and write the batches of messages that the fetcher tasks,
+    a list of (sync, task), put into the batches queue until they're all
+    done or each Sync has reached its fetch_limit.
+
+    The sync is a pipeline of three stages: batches are fetched by tasks on
+    the event loop into a bounded queue, transformed here, and written to
+    the DB on each Sync's writer thread. The transform runs on this thread,
+    which also runs the loop, so the fetchers only make progress while it
+    waits (for a batch or a write) and in the turns that the transform
+    gives the loop every _TRANSFORM_CHUNK messages. A batch is only
+    written once the previous one of its Sync has been, so the last synced
+    message in the DB (or the checkpoint of a backfill segment) stays the
+    point to resume from if any stage fails. At most _QUEUE_SIZE batches
+    wait in the queue, with one being transformed and one being written
+    per Sync.
+    """
+    loop = syncs[0].client.loop
+    for s in syncs:
+        s._n, s._last, s._start = 0, None, time.monotonic()
+
+    # Number of active fetchers of each Sync.
+    active = {s: 0 for s in syncs}
+    for s, _ in fetchers:
+        active[s] += 1
+
+    tasks = [f for _, f in fetchers]
+    try:
+        while any(active.values()):
+            s, segment, msgs = loop.run_until_complete(_next_batch(batches, tasks))
+
+            # Batches of a Sync that has reached its fetch_limit.
+            if not active[s]:
+                continue
+
+            if msgs is None:
+                active[s] -= 1
+                s._on_done(segment)
+                continue
+
+            if not s._on_batch(segment, msgs):
+                active[s] = 0
+                for fs, f in fetchers:
+                    if fs is s:
+                        f.cancel()
+
+        for s in syncs:
+            s._flush()
+    finally:
+        for f in tasks:
+            f.cancel()
+
+
+async def _next_batch(batches, fetchers):
+    """Get the next fetched batch, raising the error of a fetcher that has failed."""
+    get = asyncio.ensure_future(batches.get())
+    await asyncio.wait([get, *fetchers], return_when=asyncio.FIRST_COMPLETED)
+    if not get.done():
+        for f in fetchers:
+            if f.done() and not f.cancelled() and f.exception():
+                get.cancel()
+                raise f.exception()
+
+    return await get